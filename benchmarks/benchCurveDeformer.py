@@ -0,0 +1,198 @@
+'''
+Benchmarks of NurbsCurve and of the curveDeformer pipeline, outside of maya.
+
+Generates synthetic curves (varying the number of CVs and the degree),
+synthetic cylinders skinned along the curve and joint chains, then times
+separately the point / tangent evaluation, the closest point solve, the
+initialize stage and the per-frame deform stage. Results are reported in vertices (or params) per
+second and saved as json, to compare runs over time :
+
+python benchmarks/benchCurveDeformer.py -o bench_output.json
+python benchmarks/benchCurveDeformer.py --quick
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from timeit import default_timer
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import nurbsCurve
+import curveDeformerCore
+
+
+def make_curve(num_cvs, degree, length=10.):
+    '''
+    Returns the CVs and clamped uniform knots of a wavy curve along X
+    '''
+    cvs = np.zeros([num_cvs, 3])
+    cvs[:, 0] = np.linspace(0, length, num_cvs)
+    cvs[:, 1] = .5 * np.sin(np.linspace(0, 2*np.pi, num_cvs))
+    num_spans = num_cvs - degree
+    knots = [0.] * degree + [float(i) for i in xrange(num_spans + 1)] + [float(num_spans)] * degree
+    return cvs, knots
+
+
+def make_joint_chain(crv, num_jts):
+    '''
+    Returns the bind matrices of a joint chain placed along the curve
+    '''
+    params = np.linspace(0, crv._knots[-1] - 1e-6, num_jts)
+    jts_mats = np.tile(np.eye(4), (num_jts, 1, 1))
+    jts_mats[:, 3, :3] = crv.pt_at_params(params)
+    return jts_mats
+
+
+def make_skin_weights(num_cvs, num_jts):
+    '''
+    Each CV is skinned to its 2 closest joints along the chain
+    '''
+    weights = np.zeros([num_cvs, num_jts])
+    jt_coords = np.linspace(0, num_jts - 1, num_cvs)
+    first_jts = np.minimum(np.floor(jt_coords).astype(int), num_jts - 2)
+    blend = jt_coords - first_jts
+    weights[np.arange(num_cvs), first_jts] = 1 - blend
+    weights[np.arange(num_cvs), first_jts + 1] = blend
+    return weights
+
+
+def make_cylinder(crv, num_vertices, per_ring=32, radius=1.):
+    '''
+    Returns the positions of a cylinder around the curve, with the
+    parameter and offset of each vertex (known by construction)
+    '''
+    num_rings = max(2, -(-num_vertices // per_ring))
+    params = np.repeat(np.linspace(1e-3, crv._knots[-1] - 1e-3, num_rings), per_ring)[:num_vertices]
+    angles = np.tile(np.linspace(0, 2*np.pi, per_ring, endpoint=False), num_rings)[:num_vertices]
+    offsets = np.stack([np.zeros_like(angles), np.cos(angles), np.sin(angles)], axis=1) * radius
+    positions = crv.pt_at_params(params) + offsets
+    return positions, params, offsets
+
+
+def animate(jts_mats, cvs, frame):
+    '''
+    Returns the joint matrices and CVs of the given frame : each joint
+    rotates a little around Z, and the CVs wave up and down
+    '''
+    angle = .1 * np.sin(.3 * frame)
+    rot = curveDeformerCore.eulers_to_matrices([[0., 0., angle]])[0]
+    frame_mats = np.matmul(rot[None], jts_mats)
+    frame_mats[:, 3, :3] = jts_mats[:, 3, :3]
+    frame_cvs = cvs.copy()
+    frame_cvs[:, 1] += .2 * np.sin(.3 * frame + np.arange(len(cvs)))
+    return frame_mats, frame_cvs
+
+
+def timed(func, repeat):
+    '''
+    Returns the best time of func over repeat runs
+    '''
+    times = []
+    for _ in xrange(repeat):
+        start = default_timer()
+        func()
+        times.append(default_timer() - start)
+    return min(times)
+
+
+def bench_curve(num_cvs, degree, num_params, repeat):
+    cvs, knots = make_curve(num_cvs, degree)
+    crv = nurbsCurve.NurbsCurve(points=cvs, knots=knots, degree=degree)
+    ts = np.random.RandomState(0).uniform(0, knots[-1], num_params)
+    results = []
+    for name, func in (('pt_at_params', lambda: crv.pt_at_params(ts)),
+                       ('tan_at_params', lambda: crv.tan_at_params(ts))):
+        seconds = timed(func, repeat)
+        results.append({'stage': name, 'num_cvs': num_cvs, 'degree': degree,
+                        'num_params': num_params, 'seconds': seconds,
+                        'params_per_second': num_params / seconds})
+    # scalar evaluation, on a smaller sample as it's way slower
+    scalar_ts = ts[:1000]
+    seconds = timed(lambda: [crv.pt_at_param(t) for t in scalar_ts], repeat)
+    results.append({'stage': 'pt_at_param', 'num_cvs': num_cvs, 'degree': degree,
+                    'num_params': len(scalar_ts), 'seconds': seconds,
+                    'params_per_second': len(scalar_ts) / seconds})
+    return results
+
+
+def bench_deformer(num_vertices, num_cvs, num_jts, degree, num_frames, repeat):
+    cvs, knots = make_curve(num_cvs, degree)
+    crv = nurbsCurve.NurbsCurve(points=cvs, knots=knots, degree=degree)
+    jts_mats = make_joint_chain(crv, num_jts)
+    jts_pos = jts_mats[:, 3, :3]
+    skin_weights = make_skin_weights(num_cvs, num_jts)
+    positions, params, offsets = make_cylinder(crv, num_vertices)
+    config = {'num_vertices': len(positions), 'num_cvs': num_cvs,
+              'num_jts': num_jts, 'degree': degree}
+
+    # no output cache, the repeats would only time cache hits
+    core = curveDeformerCore.CurveDeformerCore(cache_size=0)
+    # initialize solves the closest points itself, also timed on its own
+    init = lambda: core.initialize(positions, cvs, knots, degree, jts_mats, skin_weights, jts_pos)
+    init_seconds = timed(init, repeat)
+    closest_seconds = timed(lambda: crv.closest_params(positions), repeat)
+
+    frames = [animate(jts_mats, cvs, frame) for frame in xrange(num_frames)]
+    def deform_frames():
+        for frame_mats, frame_cvs in frames:
+            core.deform(positions, frame_cvs, knots, degree, frame_mats, frame_mats[:, 3, :3])
+    deform_seconds = timed(deform_frames, repeat) / num_frames
+
+    results = []
+    for stage, seconds in (('closest_params', closest_seconds), ('initialize', init_seconds),
+                           ('deform', deform_seconds)):
+        result = dict(config)
+        result.update({'stage': stage, 'seconds': seconds,
+                       'vertices_per_second': len(positions) / seconds})
+        results.append(result)
+    return results
+
+
+def run(quick=False, repeat=3, num_frames=5):
+    if quick:
+        curve_configs  = [(8, 3), (32, 3)]
+        deform_configs = [(1000, 8, 3), (10000, 16, 10)]
+    else:
+        curve_configs  = [(num_cvs, degree) for num_cvs in (8, 32, 128) for degree in (1, 2, 3, 5)]
+        deform_configs = [(num_vertices, num_cvs, num_jts)
+                          for num_vertices in (1000, 10000, 50000, 200000)
+                          for num_cvs, num_jts in ((8, 3), (20, 20), (40, 200))]
+    results = []
+    for num_cvs, degree in curve_configs:
+        results.extend(bench_curve(num_cvs, degree, 10000, repeat))
+    for num_vertices, num_cvs, num_jts in deform_configs:
+        results.extend(bench_deformer(num_vertices, num_cvs, num_jts, 3, num_frames, repeat))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', default='bench_output.json', help='json file the results are saved to')
+    parser.add_argument('--quick', action='store_true', help='only run a few small configurations')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each timing, the best one is kept')
+    parser.add_argument('--frames', type=int, default=5, help='number of frames deformed per deform timing')
+    args = parser.parse_args(argv)
+
+    results = run(quick=args.quick, repeat=args.repeat, num_frames=args.frames)
+    for result in results:
+        rate = result.get('vertices_per_second', result.get('params_per_second'))
+        print('%-14s %s : %.4fs, %.0f /s' % (result['stage'],
+                                             ', '.join('%s=%s' % (key, result[key]) for key in sorted(result)
+                                                       if key.startswith('num_') or key == 'degree'),
+                                             result['seconds'], rate))
+
+    report = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'machine': platform.machine(),
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
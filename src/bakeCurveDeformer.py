@@ -0,0 +1,175 @@
+'''
+Bakes the curveDeformer over a frame range, without maya : the bind data
+saved by the node (see the bindCacheDirectory attribute) is deformed by
+the animated joint matrices and inCrv CVs of every frame, and the deformed
+positions are written to a memory-mapped (F, V, 3) float32 .npy point
+cache. The frames are distributed across a pool of processes, each one
+mapping the same bind data and writing its frames in the same output file.
+
+The inputs are .npy files :
+- positions      : (V, 3) input positions of the mesh
+- joint matrices : (F, J, 4, 4) matrix of each skinCluster influence
+- cvs            : (F, C, 3) CVs of the inCrv
+- Tau joints     : (F, K, 3) position of the joints connected to matrixJoints
+
+python src/bakeCurveDeformer.py bind.cdbind -p positions.npy -m matrices.npy
+                                -c cvs.npy -t tau_joints.npy -o cache.npy
+'''
+import argparse
+import multiprocessing
+
+import numpy as np
+
+import bindData
+import curveDeformerCore
+
+
+# state of a worker process, set by _init_worker
+_worker = {}
+
+
+def _as_array(array):
+    '''
+    Returns the array, or the content of a .npy file, mapped and not read
+    '''
+    if isinstance(array, basestring):
+        return np.load(array, mmap_mode='r')
+    return np.asarray(array)
+
+
+def _init_worker(bind_path, inputs, output_path):
+    '''
+    Maps the bind data, the inputs and the output of a worker process
+    '''
+    loaded = bindData.load(bind_path)
+    if loaded is None:
+        raise IOError('No valid bind data in %s' % bind_path)
+    bind_data, base_knots, base_degree = loaded
+    core = curveDeformerCore.CurveDeformerCore(cache_size=0)
+    core.load_bind_data(bind_data, base_knots, base_degree)
+    inputs = dict(inputs)
+    for name in ('positions', 'jts_mats', 'cvs', 'jts_pos', 'cv_weights', 'paint_weights'):
+        if inputs[name] is not None:
+            inputs[name] = _as_array(inputs[name])
+    if inputs['knots'] is None:
+        inputs['knots'], inputs['degree'] = base_knots, base_degree
+    _worker.update({'core': core, 'inputs': inputs,
+                    'output': np.load(output_path, mmap_mode='r+')})
+
+
+def _bake_frames(frames):
+    '''
+    Deforms the given frames and writes them in the output. The frames are
+    consecutive, so the core only computes what changed since the last one
+    :return     : number of frames baked
+    :return type: int
+    '''
+    core, inputs, output = _worker['core'], _worker['inputs'], _worker['output']
+    for frame in frames:
+        output[frame] = core.deform(inputs['positions'],
+                                    inputs['cvs'][frame],
+                                    inputs['knots'],
+                                    inputs['degree'],
+                                    inputs['jts_mats'][frame],
+                                    inputs['jts_pos'][frame],
+                                    inputs['cv_weights'],
+                                    inputs['envelope'],
+                                    inputs['paint_weights'])
+    output.flush()
+    return len(frames)
+
+
+def bake(bind_path, positions, jts_mats, cvs, jts_pos, output_path, knots=None, degree=None,
+         cv_weights=None, envelope=1., paint_weights=None, num_processes=None, frames_per_task=10):
+    '''
+    Deforms all the frames and writes them in a memory-mapped .npy file
+    :param       bind_path: bind data file saved by the node
+    :type        bind_path: str
+    :param       positions: input position of each vertex
+    :type        positions: np.array of shape (V, 3), or path to a .npy
+    :param        jts_mats: matrix of each joint influencing the curve, per frame
+    :type         jts_mats: np.array of shape (F, J, 4, 4), or path to a .npy
+    :param             cvs: CVs of the in curve, per frame
+    :type              cvs: np.array of shape (F, C, 3), or path to a .npy
+    :param         jts_pos: position of the joints used to compute Tau, per frame
+    :type          jts_pos: np.array of shape (F, K, 3), or path to a .npy
+    :param     output_path: .npy file the deformed positions are written to
+    :type      output_path: str
+    :param           knots: knot vector of the in curve, the one of the base
+                            curve if not given
+    :type            knots: list of float
+    :param          degree: degree of the in curve
+    :type           degree: int
+    :param      cv_weights: weight of each CV of the curve, 1 by default
+    :type       cv_weights: np.array of shape (C,)
+    :param        envelope: envelope of the deformer
+    :type         envelope: float
+    :param   paint_weights: painted weight of each vertex, 1 by default
+    :type    paint_weights: np.array of shape (V,)
+    :param   num_processes: number of processes, one per core if not given.
+                            1 bakes in the current process
+    :type    num_processes: int
+    :param frames_per_task: number of consecutive frames baked by a process
+                            at once
+    :type  frames_per_task: int
+    :return     : the deformed positions, mapped from the output file
+    :return type: np.memmap of shape (F, V, 3)
+    '''
+    # check the bind data and the inputs here : a worker failing in the
+    # pool initializer would be respawned forever
+    num_frames = len(_as_array(jts_mats))
+    num_jts = _as_array(jts_pos).shape[1]
+    if bindData.load(bind_path, num_jts=num_jts) is None:
+        raise IOError('No valid bind data for %d Tau joints in %s' % (num_jts, bind_path))
+    for name, array in (('cvs', cvs), ('jts_pos', jts_pos)):
+        if len(_as_array(array)) != num_frames:
+            raise ValueError('%s has %d frames, the joint matrices have %d' % (name, len(_as_array(array)), num_frames))
+    num_vertices = len(_as_array(positions))
+
+    inputs = {'positions': positions, 'jts_mats': jts_mats, 'cvs': cvs, 'jts_pos': jts_pos,
+              'knots': knots, 'degree': degree, 'cv_weights': cv_weights,
+              'envelope': envelope, 'paint_weights': paint_weights}
+    output = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32,
+                                       shape=(num_frames, num_vertices, 3))
+    del output  # each process maps it
+
+    tasks = [range(start, min(start + frames_per_task, num_frames))
+             for start in xrange(0, num_frames, frames_per_task)]
+    if num_processes == 1:
+        _init_worker(bind_path, inputs, output_path)
+        for frames in tasks:
+            _bake_frames(frames)
+        _worker.clear()
+    else:
+        pool = multiprocessing.Pool(num_processes, initializer=_init_worker,
+                                    initargs=(bind_path, inputs, output_path))
+        try:
+            pool.map(_bake_frames, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return np.load(output_path, mmap_mode='r')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('bind', help='bind data file saved by the curveDeformer node')
+    parser.add_argument('-p', '--positions', required=True, help='(V, 3) input positions .npy')
+    parser.add_argument('-m', '--joint-matrices', required=True, help='(F, J, 4, 4) joint matrices .npy')
+    parser.add_argument('-c', '--cvs', required=True, help='(F, C, 3) inCrv CVs .npy')
+    parser.add_argument('-t', '--tau-joints', required=True, help='(F, K, 3) Tau joint positions .npy')
+    parser.add_argument('-o', '--output', required=True, help='(F, V, 3) point cache .npy written')
+    parser.add_argument('--cv-weights', help='(C,) CV weights .npy')
+    parser.add_argument('--paint-weights', help='(V,) painted weights .npy')
+    parser.add_argument('--envelope', type=float, default=1., help='envelope of the deformer')
+    parser.add_argument('--processes', type=int, default=None, help='number of processes, one per core by default')
+    parser.add_argument('--frames-per-task', type=int, default=10, help='consecutive frames baked by a process at once')
+    args = parser.parse_args(argv)
+
+    bake(args.bind, args.positions, args.joint_matrices, args.cvs, args.tau_joints, args.output,
+         cv_weights=args.cv_weights, envelope=args.envelope, paint_weights=args.paint_weights,
+         num_processes=args.processes, frames_per_task=args.frames_per_task)
+
+
+if __name__ == '__main__':
+    main()
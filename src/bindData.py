@@ -0,0 +1,317 @@
+import hashlib
+import json
+import os
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+
+# bind data files : a magic string, the length of a json header, the json
+# header (version, key, base curve, Tau joints at bind time, and the dtype,
+# shape and offset of each array), then the raw arrays, each aligned so it
+# can be mapped as it is
+FILE_VERSION = 3
+FILE_EXTENSION = '.cdbind'
+_MAGIC = b'CDBIND\x00\x00'
+_ALIGNMENT = 64
+
+
+def index_dtype(max_value):
+    '''
+    Returns the smallest signed integer type able to store indices up to
+    max_value (int16 for the joints of most rigs, int32 otherwise)
+    '''
+    return np.int16 if max_value < np.iinfo(np.int16).max else np.int32
+
+
+class SkinWeights(object):
+    '''
+    Skin weights stored as a CSR sparse matrix : the weights of the CV i
+    are values[indptr[i]:indptr[i+1]], for the influences
+    indices[indptr[i]:indptr[i+1]]. A CV is usually skinned to a few joints
+    only, so most of the dense (C, J) matrix would be zeros.
+
+    weights = SkinWeights.from_dense([[1., 0., 0.], [.5, .5, 0.]])
+    blended = weights.dot(eulers)  # (C, 3), from (J, 3)
+    '''
+    def __init__(self, indptr, indices, values, num_influences):
+        '''
+        :param         indptr: start of the weights of each CV in indices
+                               and values, plus the total number of weights
+        :type          indptr: np.array of shape (C+1,)
+        :param        indices: influence index of each weight
+        :type         indices: np.array of shape (N,)
+        :param         values: weights
+        :type          values: np.array of shape (N,)
+        :param num_influences: number of influences of the skinCluster
+        :type  num_influences: int
+        '''
+        self.indptr = np.ascontiguousarray(indptr, dtype=np.int32)
+        self.indices = np.ascontiguousarray(indices, dtype=index_dtype(num_influences))
+        self.values = np.ascontiguousarray(values, dtype=np.float64)
+        self.num_influences = int(num_influences)
+        # row of each weight, so the products are a single scatter-add
+        self._rows = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        # influences having a weight on at least one CV, the matrices of the
+        # other ones are never used
+        self.influences = np.unique(self.indices)
+
+    @classmethod
+    def from_dense(cls, weights, max_influences=None):
+        '''
+        :param        weights: weight of each influence, for each CV
+        :type         weights: np.array of shape (C, J)
+        :param max_influences: if given, only the max_influences largest 
+                               weights of each CV are kept, and scaled so 
+                               their sum doesn't change
+        :type  max_influences: int
+        '''
+        weights = np.array(weights, dtype=float)
+        if max_influences and max_influences < weights.shape[1]:
+            sums = weights.sum(axis=1)
+            smallest = np.argsort(-weights, axis=1, kind='mergesort')[:, max_influences:]
+            weights[np.arange(len(weights))[:, None], smallest] = 0
+            pruned_sums = weights.sum(axis=1)
+            valid = pruned_sums != 0
+            weights[valid] *= (sums[valid] / pruned_sums[valid])[:, None]
+        rows, indices = np.nonzero(weights)
+        indptr = np.zeros(len(weights) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(rows, minlength=len(weights)), out=indptr[1:])
+        return cls(indptr, indices, weights[rows, indices], weights.shape[1])
+
+    @property
+    def num_rows(self):
+        return len(self.indptr) - 1
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.values.nbytes
+
+    def to_dense(self):
+        '''
+        :return type: np.array of shape (C, J)
+        '''
+        dense = np.zeros([self.num_rows, self.num_influences])
+        dense[self._rows, self.indices] = self.values
+        return dense
+
+    def dot(self, array):
+        '''
+        Returns the product of the weights by an array of one value per
+        influence, only visiting the nonzero weights
+        :param array: values of each influence
+        :type  array: np.array of shape (J, ...)
+        :return type: np.array of shape (C, ...)
+        '''
+        array = np.asarray(array, dtype=float)
+        out = np.zeros((self.num_rows,) + array.shape[1:])
+        weighted = array[self.indices] * self.values.reshape((-1,) + (1,) * (array.ndim - 1))
+        np.add.at(out, self._rows, weighted)
+        return out
+
+
+class BindData(object):
+    '''
+    Everything the initialize stage computes, stored in contiguous typed
+    arrays with a fixed layout, so the deform consumes them as they are
+    and they can be saved or mapped from a file as raw buffers. The
+    per-vertex arrays are the bulk of the memory of a deformer, they're
+    stored in the smallest type that keeps the precision we need.
+    '''
+    def __init__(self, params, offsets, closest_jts_idx, default_taus, directions_mat,
+                 dist_cv_weights, base_inv_mats_per_cv, skin_weights, rotation_blend=0):
+        '''
+        :param               params: parameter of the closest point on the
+                                     base curve, of each vertex
+        :type                params: np.array of shape (V,)
+        :param              offsets: vector closest point on base curve -> vertex
+        :type               offsets: np.array of shape (V, 3)
+        :param      closest_jts_idx: indices of the P, O, Q joints of each vertex
+        :type       closest_jts_idx: np.array of shape (V, 3)
+        :param         default_taus: Tau of each vertex at bind time
+        :type          default_taus: np.array of shape (V,)
+        :param       directions_mat: 1 or -1 to push or pull each offset CV, 0
+                                     if it's on the vertex
+        :type        directions_mat: np.array of shape (V, C)
+        :param      dist_cv_weights: inverse distance weight of each CV
+        :type       dist_cv_weights: np.array of shape (C,)
+        :param base_inv_mats_per_cv: inverse of the bind matrix of each CV
+        :type  base_inv_mats_per_cv: np.array of shape (C, 4, 4)
+        :param         skin_weights: weight of each joint, for each CV
+        :type          skin_weights: SkinWeights
+        :param       rotation_blend: how the joint rotations are blended for 
+                                     each CV (see curveDeformerCore)
+        :type        rotation_blend: int
+        '''
+        self.params = np.ascontiguousarray(params, dtype=np.float64)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.float32)
+        self.closest_jts_idx = np.ascontiguousarray(closest_jts_idx,
+                                                    dtype=index_dtype(np.max(closest_jts_idx)))
+        self.default_taus = np.ascontiguousarray(default_taus, dtype=np.float32)
+        self.directions_mat = np.ascontiguousarray(directions_mat, dtype=np.int8)
+        self.dist_cv_weights = np.ascontiguousarray(dist_cv_weights, dtype=np.float64)
+        self.base_inv_mats_per_cv = np.ascontiguousarray(base_inv_mats_per_cv, dtype=np.float64)
+        self.skin_weights = skin_weights
+        self.rotation_blend = int(rotation_blend)
+
+    @property
+    def num_vertices(self):
+        return len(self.params)
+
+    @property
+    def num_cvs(self):
+        return len(self.dist_cv_weights)
+
+    def arrays(self):
+        '''
+        Returns all the arrays of the bind data, by name, in a fixed order
+        :return type: OrderedDict
+        '''
+        return OrderedDict([('params', self.params),
+                            ('offsets', self.offsets),
+                            ('closest_jts_idx', self.closest_jts_idx),
+                            ('default_taus', self.default_taus),
+                            ('directions_mat', self.directions_mat),
+                            ('dist_cv_weights', self.dist_cv_weights),
+                            ('base_inv_mats_per_cv', self.base_inv_mats_per_cv),
+                            ('skin_weights_indptr', self.skin_weights.indptr),
+                            ('skin_weights_indices', self.skin_weights.indices),
+                            ('skin_weights_values', self.skin_weights.values)])
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays().values())
+
+
+def _align(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def bind_key(positions, base_cvs, knots, degree, bind_pose, skin_weights, rotation_blend=0):
+    '''
+    Returns a hash of the inputs of the bind data that don't animate : the 
+    base mesh, the base curve, the joints bind pose, the skin weights of the
+    curve and the rotation blend mode. The Tau joints animate, so they're 
+    checked by load() instead.
+    The bind data saved with the same key can be used instead of
+    initializing again
+    :param      positions: position of each vertex of the base mesh
+    :type       positions: np.array of shape (V, 3)
+    :param       base_cvs: CVs of the base curve
+    :type        base_cvs: np.array of shape (C, 3)
+    :param      bind_pose: bind matrix of each joint
+    :type       bind_pose: np.array of shape (J, 4, 4)
+    :param   skin_weights: weight of each joint, for each CV
+    :type    skin_weights: SkinWeights
+    :param rotation_blend: how the joint rotations are blended for each CV
+    :type  rotation_blend: int
+    :return type: str
+    '''
+    sha = hashlib.sha1()
+    sha.update(repr((FILE_VERSION, int(degree), [float(knot) for knot in knots], int(rotation_blend))).encode())
+    for array in (positions, base_cvs, bind_pose, skin_weights.indptr, 
+                  skin_weights.indices, skin_weights.values):
+        array = np.ascontiguousarray(array)
+        sha.update(repr((array.dtype.str, array.shape)).encode())
+        sha.update(array.tobytes())
+    return sha.hexdigest()
+
+
+def save(bind_data, path, key, knots, degree, jts_pos):
+    '''
+    Writes the bind data to a file that load() maps back in memory. The file
+    is written next to its final path then renamed, so a reader never sees 
+    it half written
+    :param bind_data: bind data to save
+    :type  bind_data: BindData
+    :param      path: path of the file
+    :type       path: str
+    :param       key: hash of the inputs of the bind (see bind_key)
+    :type        key: str
+    :param     knots: knot vector of the base curve
+    :type      knots: list of float
+    :param    degree: degree of the base curve
+    :type     degree: int
+    :param   jts_pos: position of the joints used to compute Tau, at bind time
+    :type    jts_pos: np.array of shape (K, 3)
+    '''
+    entries = []
+    offset = 0
+    for name, array in bind_data.arrays().items():
+        offset = _align(offset)
+        entries.append({'name': name, 'dtype': array.dtype.str, 
+                        'shape': list(array.shape), 'offset': offset})
+        offset += array.nbytes
+    header = json.dumps({'version': FILE_VERSION, 'key': key, 
+                         'knots': [float(knot) for knot in knots], 'degree': int(degree),
+                         'num_influences': bind_data.skin_weights.num_influences,
+                         'rotation_blend': bind_data.rotation_blend,
+                         'jts_pos': np.asarray(jts_pos, dtype=float).tolist(),
+                         'arrays': entries}).encode()
+    data_start = _align(len(_MAGIC) + 4 + len(header))
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for entry, array in zip(entries, bind_data.arrays().values()):
+            f.write(b'\x00' * (data_start + entry['offset'] - f.tell()))
+            f.write(np.ascontiguousarray(array).tobytes())
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def load(path, key=None, num_jts=None):
+    '''
+    Maps the bind data saved in a file. The arrays are views on the mapped
+    file, nothing is copied : the pages are only read when the deform uses
+    them, and shared between the processes mapping the same file
+    :param path: path of the file
+    :type  path: str
+    :param  key: expected hash of the inputs of the bind. The file is
+                 ignored if it was saved with another key
+    :type   key: str
+    :param num_jts: expected number of joints used to compute Tau. The file
+                    is ignored if it was bound with another number of joints
+                    (their positions at bind time are in the header, but 
+                    they animate, so they can't be compared with the 
+                    current ones)
+    :type  num_jts: int
+    :return     : the bind data, and the knots and degree of the base curve, 
+                  or None if there's no valid file
+    :return type: tuple(BindData, list of float, int)
+    '''
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            return None
+        header_length, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_length).decode())
+    if header['version'] != FILE_VERSION or (key is not None and header['key'] != key):
+        return None
+    if num_jts is not None and len(header['jts_pos']) != num_jts:
+        return None
+
+    data_start = _align(len(_MAGIC) + 4 + header_length)
+    mapped = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {}
+    for entry in header['arrays']:
+        dtype = np.dtype(str(entry['dtype']))
+        shape = tuple(entry['shape'])
+        start = data_start + entry['offset']
+        num_bytes = int(np.prod(shape)) * dtype.itemsize
+        arrays[str(entry['name'])] = mapped[start:start+num_bytes].view(dtype).reshape(shape)
+
+    skin_weights = SkinWeights(arrays.pop('skin_weights_indptr'), 
+                               arrays.pop('skin_weights_indices'), 
+                               arrays.pop('skin_weights_values'), 
+                               header['num_influences'])
+    return (BindData(skin_weights=skin_weights, rotation_blend=header['rotation_blend'], **arrays), 
+            header['knots'], header['degree'])
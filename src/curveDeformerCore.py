@@ -0,0 +1,965 @@
+import hashlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import bindData
+import nurbsCurve
+import spatialIndex
+import stageProfiler
+
+
+# how the rotations of the joints are blended to get the matrix of a CV
+ROTATION_BLEND_EULER = 0
+ROTATION_BLEND_QUATERNION = 1
+
+
+def matrices_to_eulers(mats):
+    '''
+    Returns the XYZ euler rotation of each matrix, like
+    MTransformationMatrix(mat).rotation().asEulerRotation() does. The scale
+    is removed from the rows before extracting the rotation
+    :param mats: matrices, using the maya convention (row vectors, the
+                 translation is the last row)
+    :type  mats: np.array of shape (J, 4, 4)
+    :return     : euler XYZ rotations, in radians
+    :return type: np.array of shape (J, 3)
+    '''
+    rot = np.asarray(mats, dtype=float)[:, :3, :3]
+    rot = rot / np.linalg.norm(rot, axis=2)[:, :, None]
+    eulers = np.zeros([len(rot), 3])
+    eulers[:, 0] = np.arctan2(rot[:, 1, 2], rot[:, 2, 2])
+    eulers[:, 1] = np.arcsin(np.clip(-rot[:, 0, 2], -1., 1.))
+    eulers[:, 2] = np.arctan2(rot[:, 0, 1], rot[:, 0, 0])
+    return eulers
+
+
+def eulers_to_matrices(eulers, positions=None):
+    '''
+    Returns the matrix of each XYZ euler rotation, like
+    MEulerRotation(x, y, z).asMatrix() does, with an optional translation
+    :param    eulers: euler XYZ rotations, in radians
+    :type     eulers: np.array of shape (C, 3)
+    :param positions: translation of each matrix
+    :type  positions: np.array of shape (C, 3)
+    :return     : matrices, using the maya convention
+    :return type: np.array of shape (C, 4, 4)
+    '''
+    eulers = np.asarray(eulers, dtype=float)
+    cx, cy, cz = np.cos(eulers).T
+    sx, sy, sz = np.sin(eulers).T
+    mats = np.zeros([len(eulers), 4, 4])
+    # Rx * Ry * Rz, with row vectors
+    mats[:, 0, 0] = cy*cz
+    mats[:, 0, 1] = cy*sz
+    mats[:, 0, 2] = -sy
+    mats[:, 1, 0] = sx*sy*cz - cx*sz
+    mats[:, 1, 1] = sx*sy*sz + cx*cz
+    mats[:, 1, 2] = sx*cy
+    mats[:, 2, 0] = cx*sy*cz + sx*sz
+    mats[:, 2, 1] = cx*sy*sz - sx*cz
+    mats[:, 2, 2] = cx*cy
+    mats[:, 3, 3] = 1.
+    if positions is not None:
+        mats[:, 3, :3] = positions
+    return mats
+
+
+def matrices_to_quaternions(mats):
+    '''
+    Returns the (x, y, z, w) quaternion of each matrix rotation, like
+    MTransformationMatrix(mat).rotation() does. The scale is removed from
+    the rows before extracting the rotation
+    :param mats: matrices, using the maya convention
+    :type  mats: np.array of shape (J, 4, 4)
+    :return type: np.array of shape (J, 4)
+    '''
+    m = np.asarray(mats, dtype=float)[:, :3, :3]
+    m = m / np.linalg.norm(m, axis=2)[:, :, None]
+    # the matrices are transposed compared to the usual formulas
+    # (row vectors), hence m[:, j, i] where the formulas read R(i, j)
+    trace = m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2]
+    # each matrix uses the formula dividing by its largest component, to
+    # stay stable : w, x, y or z
+    case = np.argmax(np.stack([trace, m[:, 0, 0], m[:, 1, 1], m[:, 2, 2]], axis=1), axis=1)
+    s = np.stack([1 + trace,
+                  1 + m[:, 0, 0] - m[:, 1, 1] - m[:, 2, 2],
+                  1 - m[:, 0, 0] + m[:, 1, 1] - m[:, 2, 2],
+                  1 - m[:, 0, 0] - m[:, 1, 1] + m[:, 2, 2]], axis=1)
+    s = 2 * np.sqrt(np.maximum(s[np.arange(len(m)), case], 1e-12))
+    m_xw, m_yw, m_zw = m[:, 1, 2] - m[:, 2, 1], m[:, 2, 0] - m[:, 0, 2], m[:, 0, 1] - m[:, 1, 0]
+    m_xy, m_xz, m_yz = m[:, 0, 1] + m[:, 1, 0], m[:, 0, 2] + m[:, 2, 0], m[:, 1, 2] + m[:, 2, 1]
+    # (x, y, z, w) for each case, before the division by s
+    candidates = np.stack([np.stack([m_xw, m_yw, m_zw, s*s/4], axis=1),
+                           np.stack([s*s/4, m_xy, m_xz, m_xw], axis=1),
+                           np.stack([m_xy, s*s/4, m_yz, m_yw], axis=1),
+                           np.stack([m_xz, m_yz, s*s/4, m_zw], axis=1)], axis=1)
+    return candidates[np.arange(len(m)), case] / s[:, None]
+
+
+def quaternions_to_matrices(quats, positions=None):
+    '''
+    Returns the matrix of each (x, y, z, w) quaternion, like 
+    MQuaternion.asMatrix() does, with an optional translation
+    :param     quats: unit quaternions
+    :type      quats: np.array of shape (C, 4)
+    :param positions: translation of each matrix
+    :type  positions: np.array of shape (C, 3)
+    :return     : matrices, using the maya convention
+    :return type: np.array of shape (C, 4, 4)
+    '''
+    x, y, z, w = np.asarray(quats, dtype=float).T
+    mats = np.zeros([len(x), 4, 4])
+    mats[:, 0, 0] = 1 - 2*(y*y + z*z)
+    mats[:, 0, 1] = 2*(x*y + z*w)
+    mats[:, 0, 2] = 2*(x*z - y*w)
+    mats[:, 1, 0] = 2*(x*y - z*w)
+    mats[:, 1, 1] = 1 - 2*(x*x + z*z)
+    mats[:, 1, 2] = 2*(y*z + x*w)
+    mats[:, 2, 0] = 2*(x*z + y*w)
+    mats[:, 2, 1] = 2*(y*z - x*w)
+    mats[:, 2, 2] = 1 - 2*(x*x + y*y)
+    mats[:, 3, 3] = 1.
+    if positions is not None:
+        mats[:, 3, :3] = positions
+    return mats
+
+
+def average_quaternions(quats, weights):
+    '''
+    Returns the weighted average of the quaternions, for each CV : the
+    eigenvector of the largest eigenvalue of sum(weight * q * q.T), see
+    Markley et al., "Averaging Quaternions" (also
+    https://stackoverflow.com/questions/12374087/average-of-multiple-quaternions)
+    Unlike averaging the components, the result doesn't depend on the
+    sign of the quaternions. All the CVs are solved in one batched eigh
+    :param   quats: quaternion of each joint
+    :type    quats: np.array of shape (J, 4)
+    :param weights: weight of each joint, for each CV
+    :type  weights: bindData.SkinWeights
+    :return type: np.array of shape (C, 4)
+    '''
+    quats = np.asarray(quats, dtype=float)
+    accumulators = weights.dot(quats[:, :, None] * quats[:, None, :])
+    eigen_vectors = np.linalg.eigh(accumulators)[1]
+    return eigen_vectors[:, :, -1]
+
+
+class CurveDeformerCore(object):
+    '''
+    Offset-Curve-Deformation, without any dependency to maya : everything
+    is given and returned as numpy arrays, so it can run (and be profiled,
+    batched or tested) outside of a maya session. The curveDeformer node is
+    only an adapter that reads its inputs and calls initialize / deform.
+    See the curveDeformer node for the details of the algorithm.
+
+    core = CurveDeformerCore()
+    core.initialize(positions, base_cvs, knots, degree, jts_mats,
+                    skin_weights, jts_pos)
+    new_positions = core.deform(positions, cvs, knots, degree, jts_mats, jts_pos)
+    '''
+    def __init__(self, cache_size=8, num_threads=1, chunk_size=4096):
+        '''
+        :param  cache_size: number of recent outputs kept, so scrubbing or 
+                            looping over the same frames doesn't deform them 
+                            again. 0 disables the cache
+        :type   cache_size: int
+        :param num_threads: number of threads deforming the vertices
+        :type  num_threads: int
+        :param  chunk_size: number of vertices deformed at once by a thread
+        :type   chunk_size: int
+        '''
+        self.is_initialized = False
+        self.bind_data = None   # bindData.BindData, result of the initialize
+        self.cache_size = cache_size
+        self.num_threads = num_threads
+        self.chunk_size = chunk_size
+        self._pool = None
+        self._pool_size = 0
+        # wall time and calls of each stage, disabled by default
+        self.profiler = stageProfiler.StageProfiler()
+        self._output_cache = OrderedDict()  # inputs fingerprint -> output, least recent first
+        self._basis_key = None  # (degree, knots) the basis cache is valid for
+        self._crv = None        # the in curve, kept between evaluations to track its dirty spans
+        self._last_eval = None  # inputs and output of the last evaluation
+
+    def initialize(self, positions, base_cvs, knots, degree, jts_mats, skin_weights, jts_pos, 
+                   params=None, offsets=None, closest_tolerance=1e-6, 
+                   rotation_blend=ROTATION_BLEND_EULER):
+        '''
+        Computes everything that doesn't change after the bind
+        :param    positions: position of each vertex
+        :type     positions: np.array of shape (V, 3)
+        :param     base_cvs: CVs of the base curve
+        :type      base_cvs: np.array of shape (C, 3)
+        :param        knots: knot vector of the base curve (of length number 
+                             of CVs + degree + 1)
+        :type         knots: list of float
+        :param       degree: degree of the base curve
+        :type        degree: int
+        :param     jts_mats: bind matrix of each joint influencing the curve
+        :type      jts_mats: np.array of shape (J, 4, 4)
+        :param skin_weights: weight of each joint, for each CV
+        :type  skin_weights: np.array of shape (C, J), or bindData.SkinWeights
+        :param      jts_pos: position of the joints used to compute Tau,
+                             sorted by parent/child
+        :type       jts_pos: np.array of shape (K, 3)
+        :param            params: parameter of the closest point on the base
+                                  curve. Computed if not given
+        :type             params: np.array of shape (V,)
+        :param           offsets: vector closest point on base curve -> vertex.
+                                  Computed if not given
+        :type            offsets: np.array of shape (V, 3)
+        :param closest_tolerance: tolerance on the parameters, when we compute
+                                  the closest points
+        :type  closest_tolerance: float
+        :param    rotation_blend: how the joint rotations are blended for each
+                                  CV, ROTATION_BLEND_EULER or _QUATERNION
+        :type     rotation_blend: int
+        '''
+        positions = np.asarray(positions, dtype=float)
+        base_cvs = np.asarray(base_cvs, dtype=float)
+        jts_pos = np.asarray(jts_pos, dtype=float)
+        profiler = self.profiler
+        base_crv = nurbsCurve.NurbsCurve(points=base_cvs, knots=knots, degree=degree)
+        if params is None or offsets is None:
+            with profiler.stage('init.closest_points'):
+                params, offsets = base_crv.closest_params(positions, tolerance=closest_tolerance)
+        offsets = np.asarray(offsets, dtype=float)
+        # 1 - get the weights of the joints
+        if not isinstance(skin_weights, bindData.SkinWeights):
+            skin_weights = bindData.SkinWeights.from_dense(skin_weights)
+        # 2 - compute the base transformation matrix for each CV
+        with profiler.stage('init.cv_matrices'):
+            base_mats_per_cv = self.get_mat_per_cv(jts_mats, skin_weights, rotation_blend)
+        # 3 - get the 3 closest joints for each vertex, to compute Tau parameter later
+        with profiler.stage('init.closest_joints'):
+            closest_jts_idx = self.get_3_closest_jts_per_vertex(positions, jts_pos)
+        # 4 - assign a weight to each offset cv, based on inv dist from O
+        #     (O being the index of the mid joint of the first vertex)
+        P, O, Q = closest_jts_idx[0]
+        dist_cv_weights = self.inverse_distance_weighting(O, base_cvs)
+        # 5 - set the direction of the offset CVs method (in deform)
+        with profiler.stage('init.directions'):
+            directions_mat = self.set_offset_direction(positions, offsets, base_cvs, base_mats_per_cv)
+        # 6 - get the Tau values by default to remap them efficiently later
+        with profiler.stage('init.taus'):
+            default_taus = self.get_taus(jts_pos, positions, closest_jts_idx)
+
+        self.load_bind_data(bindData.BindData(params=params, 
+                                              offsets=offsets, 
+                                              closest_jts_idx=closest_jts_idx, 
+                                              default_taus=default_taus, 
+                                              directions_mat=directions_mat, 
+                                              dist_cv_weights=dist_cv_weights, 
+                                              base_inv_mats_per_cv=np.linalg.inv(base_mats_per_cv), 
+                                              skin_weights=skin_weights, 
+                                              rotation_blend=rotation_blend), 
+                            knots, degree)
+
+    def load_bind_data(self, bind_data, knots, degree):
+        '''
+        Uses bind data computed by initialize, here or in another session
+        :param bind_data: result of the initialize
+        :type  bind_data: bindData.BindData
+        :param     knots: knot vector of the base curve
+        :type      knots: list of float
+        :param    degree: degree of the base curve
+        :type     degree: int
+        '''
+        self.bind_data = bind_data
+        # cache the span and basis functions of each vertex parameter, 
+        # they only depend on the knots and the degree
+        with self.profiler.stage('init.basis_cache'):
+            base_crv = nurbsCurve.NurbsCurve(points=np.zeros([bind_data.num_cvs, 3]), knots=knots, degree=degree)
+            self.update_basis_cache(base_crv, degree, knots)
+        self._crv = None
+        self._last_eval = None
+        self._output_cache.clear()
+        self.is_initialized = True
+
+    def deform(self, positions, cvs, knots, degree, jts_mats, jts_pos, cv_weights=None, 
+               envelope=1., paint_weights=None):
+        '''
+        Returns the deformed position of each vertex, blended with its input
+        position by the envelope and its painted weight
+        :param  positions: position of each vertex
+        :type   positions: np.array of shape (V, 3)
+        :param        cvs: CVs of the in curve
+        :type         cvs: np.array of shape (C, 3)
+        :param      knots: knot vector of the in curve
+        :type       knots: list of float
+        :param     degree: degree of the in curve
+        :type      degree: int
+        :param   jts_mats: current matrix of each joint influencing the curve
+        :type    jts_mats: np.array of shape (J, 4, 4)
+        :param    jts_pos: current position of the joints used to compute Tau
+        :type     jts_pos: np.array of shape (K, 3)
+        :param cv_weights: weight of each CV of the curve, 1 by default
+        :type  cv_weights: list of float
+        :param      envelope: envelope of the deformer
+        :type       envelope: float
+        :param paint_weights: painted weight of each vertex, 1 by default.
+                              The vertices of weight 0 are not deformed at all
+        :type  paint_weights: np.array of shape (V,)
+        :return     : deformed positions
+        :return type: np.array of shape (V, 3)
+        '''
+        if not self.is_initialized:
+            raise RuntimeError('The deformer has to be initialized before deforming')
+        positions = np.asarray(positions, dtype=float)
+        cvs = np.asarray(cvs, dtype=float)
+        jts_mats = np.asarray(jts_mats, dtype=float)
+        jts_pos = np.asarray(jts_pos, dtype=float)
+        cv_weights = np.ones(len(cvs)) if cv_weights is None else np.asarray(cv_weights, dtype=float)
+        paint_weights = np.ones(len(positions)) if paint_weights is None else np.asarray(paint_weights, dtype=float)
+        vertex_weights = envelope * paint_weights
+        active = vertex_weights != 0
+        if not active.any():
+            return positions.copy()
+
+        # the same inputs give the same output : scrubbing, looping a 
+        # playback or a redraw triggered by another node don't deform again
+        profiler = self.profiler
+        key = None
+        if self.cache_size > 0:
+            with profiler.stage('deform.cache_lookup'):
+                key = self.fingerprint(positions, cvs, knots, degree, jts_mats, jts_pos, cv_weights, 
+                                       envelope, paint_weights)
+            if key in self._output_cache:
+                out_positions = self._output_cache.pop(key)
+                self._output_cache[key] = out_positions  # most recent now
+                profiler.add('deform.cache_hit', 0.)
+                return out_positions.copy()
+
+        # - get the offset matrix of each CV (cv * base_cv. The baseCV mat
+        #   has a position 0,0,0, so with only 1 matrix mult, we get the
+        #   offset in the correct position in space instead of having it
+        #   in the origin). They don't depend on the vertex, so we
+        #   compute them only once, as a (C, 4, 4) stack
+        bind_data = self.bind_data
+        with profiler.stage('deform.cv_matrices'):
+            weighted_matrices = self.get_weighted_matrices(jts_mats, bind_data.skin_weights, 
+                                                           bind_data.rotation_blend, cvs)
+            offset_mats = np.matmul(weighted_matrices, bind_data.base_inv_mats_per_cv)
+
+        # only the vertices affected by what changed since the last 
+        # evaluation are computed again
+        with profiler.stage('deform.dirty_vertices'):
+            dirty_vertices = self.get_dirty_vertices(positions, cvs, knots, degree, weighted_matrices, 
+                                                     jts_pos, cv_weights)
+        if dirty_vertices is None:
+            deformed = np.zeros([len(positions), 3])
+            computed = np.zeros(len(positions), dtype=bool)
+        else:
+            deformed = self._last_eval['deformed'].copy()
+            computed = self._last_eval['computed'] & ~dirty_vertices
+        # the vertices of weight 0 are skipped, they'll be computed when
+        # their weight isn't 0 anymore
+        vertices = np.flatnonzero(active & ~computed)
+        computed[vertices] = True
+
+        # the vertices are independent from each other, they're deformed by
+        # chunks in parallel, each chunk writing its rows of the deformed 
+        # positions
+        def deform_chunk(chunk):
+            deformed[chunk] = self.deform_vertices(chunk, positions, jts_pos, 
+                                                   offset_mats, weighted_matrices)
+        chunks = self.get_chunks(vertices, len(positions))
+        with profiler.stage('deform.vertices'):
+            if len(chunks) > 1 and self.num_threads > 1:
+                self.get_pool().map(deform_chunk, chunks)
+            else:
+                for chunk in chunks:
+                    deform_chunk(chunk)
+
+        self._last_eval = {'positions': positions.copy(), 'weighted_matrices': weighted_matrices, 
+                           'jts_pos': jts_pos.copy(), 'versions': self._crv.span_versions(), 
+                           'deformed': deformed, 'computed': computed}
+
+        # blend between the input and the deformed positions
+        with profiler.stage('deform.blend'):
+            out_positions = positions.copy()
+            active = np.flatnonzero(active)
+            out_positions[active] += vertex_weights[active, None] * (deformed[active] - positions[active])
+        if key is not None:
+            self._output_cache[key] = out_positions
+            while len(self._output_cache) > self.cache_size:
+                self._output_cache.popitem(last=False)
+        return out_positions.copy()
+
+    def get_memory_usage(self):
+        '''
+        Returns the size in bytes of each array of the bind data, and of the
+        caches built from it
+        :return type: OrderedDict
+        '''
+        usage = OrderedDict()
+        if self.bind_data is not None:
+            for name, array in self.bind_data.arrays().items():
+                usage['bind_data.' + name] = array.nbytes
+            usage['basis_cache'] = self._spans.nbytes + self._basis.nbytes + self._cv_windows.nbytes
+        usage['output_cache'] = sum(output.nbytes for output in self._output_cache.values())
+        usage['last_eval'] = sum(value.nbytes for value in (self._last_eval or {}).values() 
+                                 if isinstance(value, np.ndarray))
+        return usage
+
+    def get_stats(self):
+        '''
+        Returns the stages recorded by the profiler (see 
+        stageProfiler.StageProfiler.stats) and the memory usage
+        :return type: dict
+        '''
+        return {'stages': self.profiler.stats(), 'memory': self.get_memory_usage()}
+
+    def deform_vertices(self, vertices, positions, jts_pos, offset_mats, weighted_matrices):
+        '''
+        Returns the deformed position of some vertices, the frame state 
+        (offset matrices, weighted matrices, curve) being already computed
+        :param          vertices: vertices to deform
+        :type           vertices: slice, or np.array of int
+        :param         positions: position of all the vertices
+        :type          positions: np.array of shape (V, 3)
+        :param           jts_pos: current position of the joints used to compute Tau
+        :type            jts_pos: np.array of shape (K, 3)
+        :param       offset_mats: offset matrix of each CV
+        :type        offset_mats: np.array of shape (C, 4, 4)
+        :param weighted_matrices: weighted matrix of each CV
+        :type  weighted_matrices: np.array of shape (C, 4, 4)
+        :return type: np.array of shape (N, 3)
+        '''
+        bind_data = self.bind_data
+        # a vertex only depends on the degree+1 CVs supporting the span of
+        # its parameter, so only those offset CVs are computed
+        cv_windows = self._cv_windows[vertices]
+
+        # adds the delta of each vertex to each CV of its window, in a single
+        # batched product : (V, 3) * (V, degree+1, 3, 3) -> (V, degree+1, 3)
+        # It is super important to work with points (w=1) and not
+        # vectors (w=0) for the deltas, as an MPoint*MMatrix gives
+        # different result from MVector*MMatrix : the translation of the
+        # matrices is added
+        all_offset_cvs = np.einsum('vi,vkij->vkj', bind_data.offsets[vertices], offset_mats[:, :3, :3][cv_windows])
+        all_offset_cvs += offset_mats[:, 3, :3][cv_windows]
+
+        # compute the Tau multiplier of all the vertices
+        taus = self.get_taus(jts_pos, positions[vertices], bind_data.closest_jts_idx[vertices])
+        taus = taus - bind_data.default_taus[vertices]
+
+        # fix with Tau : push (or pull) the offset CVs of every vertex
+        # along the aim vector of their CV matrix
+        all_offset_cvs = self.offset_CVs_by_tau(all_offset_cvs,
+                                                weighted_matrices,
+                                                taus,
+                                                bind_data.dist_cv_weights,
+                                                cv_windows)
+
+        # compute all the offset curves at their vertex parameter
+        return self._crv.pt_at_params_from_window(all_offset_cvs, 
+                                                  self._spans[vertices], 
+                                                  self._basis[vertices])
+
+    def get_chunks(self, vertices, num_vertices):
+        '''
+        Splits the vertices to deform in chunks of chunk_size vertices. The
+        chunks are slices when all the vertices are deformed, that avoids
+        copying the bind data
+        :param     vertices: indices of the vertices to deform
+        :type      vertices: np.array of int
+        :param num_vertices: number of vertices of the mesh
+        :type  num_vertices: int
+        :return type: list of slice or np.array of int
+        '''
+        chunk_size = max(1, self.chunk_size)
+        if len(vertices) == num_vertices:
+            return [slice(start, start + chunk_size) for start in xrange(0, num_vertices, chunk_size)]
+        return [vertices[start:start+chunk_size] for start in xrange(0, len(vertices), chunk_size)]
+
+    def get_pool(self):
+        '''
+        Returns the pool of num_threads threads deforming the chunks. Threads
+        are enough, numpy releases the GIL during the array operations
+        '''
+        if self._pool is None or self._pool_size != self.num_threads:
+            self.close()
+            self._pool = ThreadPool(self.num_threads)
+            self._pool_size = self.num_threads
+        return self._pool
+
+    def close(self):
+        '''
+        Stops the threads of the pool, if any
+        '''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def fingerprint(self, positions, cvs, knots, degree, jts_mats, jts_pos, cv_weights, envelope, paint_weights):
+        '''
+        Returns a hash of all the inputs of deform, the key of the output cache
+        :return type: str
+        '''
+        sha = hashlib.sha1()
+        sha.update(repr((int(degree), tuple(knots), float(envelope))).encode())
+        for array in (positions, cvs, jts_mats, jts_pos, cv_weights, paint_weights):
+            sha.update(repr(array.shape).encode())
+            sha.update(np.ascontiguousarray(array, dtype=float).tobytes())
+        return sha.hexdigest()
+
+    def get_dirty_vertices(self, positions, cvs, knots, degree, weighted_matrices, jts_pos, cv_weights):
+        '''
+        Often, only a few CVs move between two evaluations (when only the 
+        wrist is keyed for instance). The CVs whose matrix or weight changed 
+        since the last evaluation are moved on the in curve, that marks as 
+        dirty only the knot spans they affect. A vertex has to be computed 
+        again if its parameter is in a dirty span, if one of its Tau joints 
+        moved, or if its input position changed
+        :return     : mask of the vertices to compute again, or None if all 
+                      the vertices have to be computed
+        :return type: np.array of bool, of shape (V,)
+        '''
+        last = self._last_eval
+        if self._crv is None or (degree, tuple(knots)) != self._basis_key:
+            # all the offset curves share the knots, degree and weights of the inCrv
+            self._crv = nurbsCurve.NurbsCurve(points=cvs, knots=knots, degree=degree, weights=cv_weights)
+            # the cached basis is only valid for the knots it was computed on
+            if (degree, tuple(knots)) != self._basis_key:
+                self.update_basis_cache(self._crv, degree, knots)
+            return None
+        if last is None or positions.shape != last['positions'].shape or jts_pos.shape != last['jts_pos'].shape:
+            self._crv.cvs = cvs
+            self._crv.weights = cv_weights
+            return None
+
+        moved_cvs = np.any(weighted_matrices != last['weighted_matrices'], axis=(1, 2))
+        self._crv.set_cvs(np.flatnonzero(moved_cvs), cvs[moved_cvs])
+        self._crv.weights = cv_weights
+        dirty_spans = self._crv.dirty_spans(last['versions'])
+
+        moved_jts = np.any(jts_pos != last['jts_pos'], axis=1)
+        return (dirty_spans[self._spans] | 
+                np.any(moved_jts[self.bind_data.closest_jts_idx], axis=1) | 
+                np.any(positions != last['positions'], axis=1))
+
+    def inverse_distance_weighting(self, pt, poses, p=2):
+        '''
+        Returns a vector of normalized weights, based on the
+        inverse distance to the reference point. If one of the
+        poses is on the reference point (i.e. distance=0),
+        we can't do the invert 1/0, so we edit manually the
+        vector to have something like [0,...,0,1,0,...]
+        Ex : pt = np.zeros([3])
+             poses = np.array([[-2,0,0],
+                               [-1,0,0],
+                               [0,0,0],
+                               [2,0,0]])
+        wts = inverse_distance_weighting(o, poses)
+
+        :param    pt: reference point, that is responsible for the weighing
+        :type     pt: np.array of n elements
+        :param poses: matrix of shape MxN of each pose we want to assign a weight to
+        :type  poses: np.array of MxN elements
+        :return: np.array of n elements, representing the weights
+        '''
+        dists = np.linalg.norm(pt - np.asarray(poses, dtype=float), axis=1)
+        on_pose = dists == 0
+        if on_pose.any():
+            weights_vec = on_pose.astype(float)
+        else:
+            weights_vec = 1. / np.power(dists, p)
+        return weights_vec / np.sum(weights_vec)
+
+    def get_mat_per_cv(self, jts_mats, weights, rotation_blend=ROTATION_BLEND_EULER):
+        ''' Computes an average of the weight for each CV, to build
+        a single matrix that is the orientation of the current CV.
+        This matrix is the weighted sum of all the joints that influence
+        this CV, using euler or quaternions (see get_weighted_matrices)
+        :param       jts_mats: matrix of each joint influencing the curve
+        :type        jts_mats: np.array of shape (J, 4, 4)
+        :param        weights: weight of each joint, for each CV
+        :type         weights: bindData.SkinWeights
+        :param rotation_blend: ROTATION_BLEND_EULER or ROTATION_BLEND_QUATERNION
+        :type  rotation_blend: int
+        :return     : rotation matrix of each CV
+        :return type: np.array of shape (C, 4, 4)
+        '''
+        return self.get_weighted_matrices(jts_mats, weights, rotation_blend)
+
+    def update_basis_cache(self, crv, degree, knots):
+        '''
+        The parameter of each vertex is fixed at init, so are the span and
+        basis functions used to evaluate its offset curve, as long as the
+        degree and the knots of the inCrv don't change. We store them, with
+        the (degree, knots) they were computed for, so the deform only does
+        a weighted sum of the CVs
+        :param    crv: curve sharing the knots and degree of the inCrv
+        :type     crv: nurbsCurve.NurbsCurve
+        '''
+        self._spans, self._basis = crv.basis_at_params(self.bind_data.params)
+        self._cv_windows = crv.cvs_indices(self._spans)
+        self._basis_key = (degree, tuple(knots))
+
+    def get_weighted_matrices(self, jts_mats, weights, rotation_blend=ROTATION_BLEND_EULER, positions=None):
+        '''
+        Takes the matrix of each joint, the weights of each joint for each CV,
+        and outputs one matrix per CV based on the input weights (and the
+        positions). The rotation is done by interpolating each joint, but the
+        translate is given (usually the position of the CP). All the CVs are
+        blended at once, as a (C, J) weights by (J, ...) rotations product :
+        - euler : the XYZ eulers of the joints are averaged
+        - quaternion : the quaternions of the joints are averaged (see 
+          average_quaternions), that doesn't flip with large rotations
+        :param       jts_mats: matrix of each joint
+        :type        jts_mats: np.array of shape (J, 4, 4)
+        :param        weights: weight of each joint, for each CV
+        :type         weights: bindData.SkinWeights
+        :param rotation_blend: ROTATION_BLEND_EULER or ROTATION_BLEND_QUATERNION
+        :type  rotation_blend: int
+        :param      positions: position of each CV
+        :type       positions: np.array of shape (C, 3)
+        :return     : matrix of each CV
+        :return type: np.array of shape (C, 4, 4)
+        '''
+        if rotation_blend == ROTATION_BLEND_QUATERNION:
+            return quaternions_to_matrices(average_quaternions(matrices_to_quaternions(jts_mats), weights), 
+                                           positions)
+        return eulers_to_matrices(weights.dot(matrices_to_eulers(jts_mats)), positions)
+
+    def get_3_closest_jts_per_vertex(self, positions, joints_pos):
+        ''' In order to compute Tau, we need to compute the angle
+        at the elbow, between shoulder and wrist. This is in an ideal setup
+        with only 3 bones. But if we have more than 3 bones, to do the same
+        computation, we need to make sure we work on the correct set of 3 bones.
+        Therefore, we need to check the 3 bones we'll used, regarding the
+        hierarchy :
+        Situation 1 - get the closest bone
+                      get its child
+                      get its parent
+        Situation 2 - get the closest bone
+                      get its child -> NO CHILD
+                      get its parent
+                      get the parent's parent.
+        Situation 3 - get the closest bone
+                      get its child
+                      get its parent -> NO PARENT
+                      get the child's child.
+
+        The closest joint of every vertex is found with a single query on a
+        spatial index of the joints, and the 3 situations are applied as
+        array operations
+
+        :param  positions: position of each vertex
+        :type   positions: np.array of shape (V, 3)
+        :param joints_pos: XYZ coordinates for each joint, sorted by parent/child
+        :type  joints_pos: list of np.array
+        :return          : for each vertex, the indices of the 3 joints
+        :return type     : np.array of int, of shape (V, 3)
+        '''
+        num_jts = len(joints_pos)
+        closest_jt_idx, _ = spatialIndex.SpatialIndex(joints_pos).query(positions)
+        # - get the child
+        child_jt_idx = closest_jt_idx+1
+        # - get the parent
+        parent_jt_idx = closest_jt_idx-1
+
+        # Situation 1
+        closest_3_jts_idx = np.stack([parent_jt_idx, closest_jt_idx, child_jt_idx], axis=1)
+        # Situation 2 - no child available
+        no_child = closest_jt_idx >= num_jts-1
+        closest_3_jts_idx[no_child] = np.stack([parent_jt_idx-1, parent_jt_idx, closest_jt_idx], axis=1)[no_child]
+        # Situation 3 - no parent available
+        no_parent = closest_jt_idx == 0
+        closest_3_jts_idx[no_parent] = [0, 1, 2]
+
+        return closest_3_jts_idx
+
+    def get_taus(self, jts_pos, positions, closest_jts_idx):
+        '''
+        Vectorized version of get_tau : computes Tau for all the vertices at
+        once. Used at init to get the default Tau values (in order to know
+        how to remap them later, in the deform : if we're in the middle of
+        the elbow, tau may be .5, but on the sides, it may be 1.2), and in
+        the deform
+        :param         jts_pos: position of each joint
+        :type          jts_pos: np.array of shape (K, 3)
+        :param       positions: position of each vertex (R)
+        :type        positions: np.array of shape (V, 3)
+        :param closest_jts_idx: indices of the joints P, O and Q of each vertex
+        :type  closest_jts_idx: np.array of shape (V, 3)
+        :return     : Tau value of each vertex
+        :return type: np.array of shape (V,)
+        '''
+        jts_pos = np.asarray(jts_pos, dtype=float)
+        closest_jts_idx = np.asarray(closest_jts_idx)
+        p_pos = jts_pos[closest_jts_idx[:, 0]]
+        o_pos = jts_pos[closest_jts_idx[:, 1]]
+        q_pos = jts_pos[closest_jts_idx[:, 2]]
+
+        # Eq. 1-3
+        p = p_pos - o_pos
+        a = np.linalg.norm(p, axis=1)
+        p_norm = p / a[:, None]
+        q = q_pos - o_pos
+        b = np.linalg.norm(q, axis=1)
+        q_norm = q / b[:, None]
+        r = positions - o_pos
+        r_length = np.linalg.norm(r, axis=1)
+        r_norm = r / r_length[:, None]
+
+        # Eq. 4-5
+        theta = np.arccos(np.clip(np.sum(r_norm * q_norm, axis=1), -1., 1.))
+        alpha_min = np.arccos(np.clip(np.sum(p_norm * q_norm, axis=1), -1., 1.))
+
+        # Eq. 6 - make sure we always have the smaller angle
+        cross_pq = np.cross(p_norm, q_norm)
+        cross_rq = np.cross(r_norm, q_norm)
+        alpha = np.where(np.sum(cross_pq * cross_rq, axis=1) >= 0, alpha_min, 2*np.pi - alpha_min)
+
+        theta_flat = theta * (np.pi/alpha)
+        # Eq. 9
+        epsilon = r_length * np.cos(theta_flat)
+
+        # Eq. 10
+        numerator = a + a*np.minimum(0, epsilon) + b*np.maximum(0, epsilon)
+        denominator = a + b
+        return numerator / denominator
+
+    def get_tau(self, jts_pos, p_idx, o_idx, q_idx, r_pos):
+        '''
+        To know how much the CVs need to be offset to sharpen / smooth
+        the curve, we compute a parameter at bind pause (we call it Tau), that
+        will vary based on the bend angle between each joint. In this setup,
+        shoulder, elbow and wrist positions are respectively P, O and Q. The
+        vertex we currently compute is known as R
+        Scalar reference of get_taus
+        :param jts_pos: position of each joint
+        :type  jts_pos: np.array of shape (K, 3)
+        :param   p_idx: index of the bone P, usually the shoulder
+        :type    p_idx: int
+        :param   o_idx: index of the bone O, usually the elbow, which rotates
+        :type    o_idx: int
+        :param   q_idx: index of the bone Q, usually the wrist
+        :type    q_idx: int
+        :param   r_pos: position of the vertex we use to get tau
+        :type    r_pos: np.array
+        :return     : float
+        '''
+        p_pos = np.array(jts_pos[p_idx])
+        o_pos = np.array(jts_pos[o_idx])
+        q_pos = np.array(jts_pos[q_idx])
+        r_pos = np.array(r_pos)
+
+        # Eq. 1-3
+        p = p_pos - o_pos
+        p_norm = p / np.linalg.norm(p)
+        q = q_pos - o_pos
+        q_norm = q / np.linalg.norm(q)
+        r = r_pos - o_pos
+        r_norm = r / np.linalg.norm(r)
+
+        # Eq. 4-5
+        theta = np.arccos(r_norm.dot(q_norm))  # angle ROQ en radians
+        alpha_min = np.arccos(p_norm.dot(q_norm)) # angle POQ en radians
+
+        # Eq. 6 - make sure we always have the smaller angle
+        cross_pq = np.cross(p_norm, q_norm)
+        cross_rq = np.cross(r_norm, q_norm)
+        if cross_pq.dot(cross_rq) >= 0:
+            alpha = alpha_min
+        else:
+            alpha = 2*np.pi - alpha_min
+
+        # alpha est flat quand alpha * (np.pi/alpha) == np.pi
+        theta_flat = theta * (np.pi/alpha)
+        # Eq. 9
+        epsilon = np.linalg.norm(r) * np.cos(theta_flat)  # epsilon = distance depuis O jusqu'a la perpidenculaire a OQ en R
+
+        # Eq. 10
+        a = np.linalg.norm(p)
+        b = np.linalg.norm(q)
+        numerator = a + a*min(0, epsilon) + b*max(0, epsilon)
+        denominator = a + b
+        tau = numerator / denominator
+
+        return tau
+
+    def set_offset_direction(self, positions, offsets, base_cvs, base_mat_bones):
+        '''
+        In order to know in which direction we'll push the CVs (using Tau) in
+        the deform, we set a matrix of values (+1 or -1) that we'll
+        use in offset_CVs_by_tau() later. In a nutshell, we get the vector
+        offset_CV->vertex, and we compare it against the main orient axis of the
+        bone (usually -and hardcoded here- +X), and the neg main orient axis
+        (-X). Then, with cosine similarity, we define if offset_CV-> vertex is
+        closer from +X or -X.
+        The bone axis only depends on the CV, so we get it once per CV, and
+        compare it with the vectors of all the vertices in a single broadcast
+        :param      positions: position of each vertex
+        :type       positions: np.array of shape (V, 3)
+        :param        offsets: offset between each vertex and the base curve
+        :type         offsets: np.array of shape (V, 3)
+        :param       base_cvs: CVs of the base curve
+        :type        base_cvs: np.array of shape (C, 3)
+        :param base_mat_bones: base matrix of each CV
+        :type  base_mat_bones: np.array of shape (C, 4, 4)
+        Returns a m x n matrix with m = number of vertices and n = number of CVs
+        each value is either 1 or -1, depending if we wanna push or pull the CV,
+        or 0 if the offset CV is on the vertex
+        '''
+        # hardcoded for now : bones are oriented in +X, so the main orient
+        # axis is the first row of the matrix
+        base_bone_orient_pos = base_mat_bones[:, 0, :3]
+
+        # vector offset_cv->vertex, with offset_cv = base_cv + offset
+        cv_to_pos = (positions - offsets)[:, None] - base_cvs[None]
+
+        # closer from +X than -X when the dot product is positive (the
+        # norms don't change the sign, no need to normalize)
+        pos_x = np.einsum('vci,ci->vc', cv_to_pos, base_bone_orient_pos)
+        out_mat = np.where(pos_x > 0, 1., -1.)
+        out_mat[~np.any(cv_to_pos, axis=2)] = 0
+        return out_mat
+
+    def offset_CVs_by_tau(self, offset_cvs, mat_bones, taus, cv_weights, cv_windows=None):
+        '''
+        We computed, in the init, whether we should pull or push the CV.
+        To know of how much we move the CV, we multiply the current bone aim
+        vector by the pre-computed direction (i.e. +1 or -1) by a remapped value of 'tau'
+        The aim vectors only depend on the CV, so they are computed once, and
+        the push is broadcast over the offset CVs of all the vertices
+        :param offset_cvs: offset cvs, after we applied the delta vector to them
+        :type  offset_cvs: np.array of shape (V, C, 3), or (V, K, 3) with 
+                           cv_windows
+        :param  mat_bones: weighted matrix of each CV
+        :type   mat_bones: np.array of shape (C, 4, 4)
+        :param       taus: Tau value of each vertex
+        :type        taus: np.array of shape (V,)
+        :param cv_weights: weight of each CV
+        :type  cv_weights: np.array of shape (C,)
+        :param cv_windows: indices of the offset cvs given for each vertex,
+                           all the CVs if not given
+        :type  cv_windows: np.array of shape (V, K)
+        :return     : the offset cvs, pushed by Tau
+        :return type: np.array of the shape of offset_cvs
+        '''
+        # hardcoded for now : bones are oriented in +X, so the aim vector is
+        # the first row of the matrix
+        bone_aim_vectors = mat_bones[:, 0, :3]
+        bone_aim_vectors = bone_aim_vectors / np.linalg.norm(bone_aim_vectors, axis=1)[:, None]
+
+        # push = bone_aim_vectors * cv_weights * cv_directions * tau
+        push = bone_aim_vectors * np.asarray(cv_weights)[:, None]
+        if cv_windows is None:
+            return offset_cvs - taus[:, None, None] * push[None]
+        return offset_cvs - taus[:, None, None] * push[cv_windows]
+
+
+def check_tau_parity(jts_pos, positions, closest_jts_idx, tolerance=1e-6):
+    '''
+    Compares the vectorized get_taus with the scalar get_tau
+    '''
+    core = CurveDeformerCore(cache_size=0)
+    taus = core.get_taus(jts_pos, positions, closest_jts_idx)
+    for i in xrange(len(positions)):
+        P, O, Q = closest_jts_idx[i]
+        tau = core.get_tau(jts_pos, P, O, Q, positions[i])
+        assert abs(tau - taus[i]) < tolerance, (i, tau, taus[i])
+
+
+def check_deform_parity(num_threads=4, chunk_size=16):
+    '''
+    Deforms a cylinder skinned along a curve over a sequence of frames 
+    (single CV moves, Tau joint moves, envelope and painted weight changes,
+    a knot change, replayed frames) with one long-lived core, that only 
+    computes what changed since the last frame, on a thread pool with small
+    chunks and an output cache. Each frame is compared with a new core 
+    without cache. Also checks a save / load round trip of the bind data, 
+    and the vectorized Tau with the scalar one
+    '''
+    import os
+    import shutil
+    import tempfile
+
+    num_cvs, degree, num_jts = 7, 3, 3
+    base_cvs = np.zeros([num_cvs, 3])
+    base_cvs[:, 0] = np.linspace(0, 10, num_cvs)
+    knots = [0] * degree + range(num_cvs - degree + 1) + [num_cvs - degree] * degree
+    crv = nurbsCurve.NurbsCurve(points=base_cvs, knots=knots, degree=degree)
+    params = np.repeat(np.linspace(.01, knots[-1] - .01, 20), 16)
+    angles = np.tile(np.linspace(0, 2 * np.pi, 16, endpoint=False), 20)
+    positions = crv.pt_at_params(params) + np.stack([np.zeros_like(angles), np.cos(angles), np.sin(angles)], axis=1)
+    base_jts_pos = np.zeros([num_jts, 3])
+    base_jts_pos[:, 0] = np.linspace(0, 10, num_jts)
+    base_jts_pos[1, 1] = .01  # Tau needs joints that aren't aligned
+    skin_weights = np.zeros([num_cvs, num_jts])
+    skin_weights[np.arange(num_cvs), np.arange(num_cvs) * num_jts // num_cvs] = 1.
+
+    # frames of (cvs, knots, joint eulers, Tau joint positions, envelope, paint weights)
+    rng = np.random.RandomState(0)
+    base_eulers = np.zeros([num_jts, 3])
+    paint_weights = rng.uniform(0, 1, len(positions))
+    paint_weights[::5] = 0.
+    frames = [(base_cvs, knots, base_eulers, base_jts_pos, 1., None)]
+    cvs = base_cvs.copy()
+    for i in xrange(num_cvs):
+        cvs = cvs.copy()
+        cvs[i] += rng.uniform(-.5, .5, 3)
+        frames.append((cvs, knots, base_eulers, base_jts_pos, 1., None))
+    eulers = base_eulers.copy()
+    eulers[1, 0] = .4
+    frames.append((cvs, knots, eulers, base_jts_pos, 1., None))
+    jts_pos = base_jts_pos.copy()
+    jts_pos[1] += [.5, .3, -.2]
+    frames.append((cvs, knots, eulers, jts_pos, 1., None))
+    frames.append((cvs, knots, eulers, jts_pos, .5, None))
+    frames.append((cvs, knots, eulers, jts_pos, .5, paint_weights))
+    paint_weights = paint_weights.copy()
+    paint_weights[:40] = 1.
+    frames.append((cvs, knots, eulers, jts_pos, 1., paint_weights))
+    moved_cvs = cvs.copy()
+    moved_cvs[3] += [0, 1, 0]
+    frames.append((moved_cvs, knots, eulers, jts_pos, 1., paint_weights))
+    frames.append((moved_cvs, [0, 0, 0, 0, .5, 2, 3, 4, 4, 4, 4], eulers, jts_pos, 1., paint_weights))
+    frames.append((moved_cvs, knots, eulers, jts_pos, 1., None))
+    frames.extend(frames[::3])  # replayed, from the output cache or not
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for rotation_blend in (ROTATION_BLEND_EULER, ROTATION_BLEND_QUATERNION):
+            bind_mats = eulers_to_matrices(base_eulers, base_jts_pos)
+            core = CurveDeformerCore(cache_size=4, num_threads=num_threads, chunk_size=chunk_size)
+            core.initialize(positions, base_cvs, knots, degree, bind_mats, skin_weights, base_jts_pos, 
+                            rotation_blend=rotation_blend)
+            check_tau_parity(base_jts_pos, positions, core.bind_data.closest_jts_idx)
+
+            # the bind data mapped back from a file deforms the same way
+            skin = bindData.SkinWeights.from_dense(skin_weights)
+            key = bindData.bind_key(positions, base_cvs, knots, degree, bind_mats, skin, rotation_blend)
+            path = os.path.join(tmp_dir, key + bindData.FILE_EXTENSION)
+            bindData.save(core.bind_data, path, key, knots, degree, base_jts_pos)
+            loaded_core = CurveDeformerCore(cache_size=0)
+            loaded_core.load_bind_data(*bindData.load(path, key, num_jts))
+            assert bindData.load(path, 'another key') is None
+            assert bindData.load(path, key, num_jts + 1) is None
+
+            for i, (cvs, crv_knots, eulers, jts_pos, envelope, paint_weights) in enumerate(frames):
+                jts_mats = eulers_to_matrices(eulers, base_jts_pos)
+                args = (positions, cvs, crv_knots, degree, jts_mats, jts_pos, None, envelope, paint_weights)
+                new_positions = core.deform(*args)
+                ref_core = CurveDeformerCore(cache_size=0)
+                ref_core.load_bind_data(core.bind_data, knots, degree)
+                ref_positions = ref_core.deform(*args)
+                assert np.array_equal(new_positions, ref_positions), \
+                    (rotation_blend, i, np.abs(new_positions - ref_positions).max())
+                loaded_positions = loaded_core.deform(*args)
+                assert np.array_equal(loaded_positions, ref_positions), \
+                    (rotation_blend, i, np.abs(loaded_positions - ref_positions).max())
+            core.close()
+            del loaded_core  # releases the mapped file
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    check_deform_parity()
@@ -1,4 +1,7 @@
 import numpy as np
+from bisect import bisect_right
+
+import spatialIndex
 
 class NurbsCurve(object):
     '''
@@ -29,31 +32,131 @@ class NurbsCurve(object):
                         the curve
         :type      LOD: int
         '''
-        self._cvs = np.asarray(points)
+        self._cvs = np.array(points, dtype=float)
         self._num_cvs = len(self._cvs)
         self._degree = degree
         self._order = self._degree + 1
         self._num_knots = self._num_cvs + self._degree + 1
         self._LOD = LOD
         self._knots = knots
+        self._np_knots = np.asarray(knots, dtype=float)
         self._out_pts = None  # the curve hasn't been computed yet
-        self._weights = weights or np.ones(self._num_cvs)
+        self._out_tans = None
+        self._weights = np.ones(self._num_cvs) if weights is None else np.asarray(weights, dtype=float)
+        # every cached quantity (samples, arc lengths) stores the version of
+        # each knot span it was computed with. Moving a CV bumps the version
+        # of the spans it affects, so only those spans are recomputed
+        self._span_versions = np.zeros(self._num_cvs, dtype=int)
+        self._samples = None  # the samples of compute_crv haven't been computed yet
+        self._arc_lengths = None  # the arc length table hasn't been computed yet
+
+    @property
+    def cvs(self):
+        return self._cvs
+
+    @cvs.setter
+    def cvs(self, points):
+        ''' Replaces all the CVs, and invalidates everything computed from them '''
+        self._cvs = np.array(points, dtype=float)
+        self._span_versions += 1
+
+    @property
+    def weights(self):
+        return self._weights
+
+    @weights.setter
+    def weights(self, weights):
+        ''' Replaces the weights, and marks as dirty the spans of the CVs whose weight changed '''
+        weights = np.asarray(weights, dtype=float)
+        changed = np.flatnonzero(weights != self._weights)
+        self._weights = weights
+        self._span_versions[self.spans_of_cvs(changed)] += 1
+
+    def set_cv(self, index, point):
+        '''
+        Moves a single CV, see set_cvs
+        '''
+        return self.set_cvs([index], [point])
+
+    def set_cvs(self, indices, points):
+        '''
+        Moves some CVs in place, and marks as dirty only the knot spans they
+        affect : the cached samples, tangents and arc lengths will only be 
+        recomputed on those spans
+        :param indices: indices of the CVs we move
+        :type  indices: array(int)
+        :param  points: new position of each of these CVs
+        :type   points: array(float3)
+        :return     : the spans marked as dirty
+        :return type: np.array of int
+        '''
+        indices = np.atleast_1d(np.asarray(indices, dtype=int))
+        self._cvs[indices] = points
+        spans = self.spans_of_cvs(indices)
+        self._span_versions[spans] += 1
+        return spans
+
+    def spans_of_cvs(self, indices):
+        '''
+        Returns the knot spans affected by the given CVs : because of the 
+        local support, the CV i only affects the spans i to i+degree
+        :return type: np.array of int
+        '''
+        indices = np.atleast_1d(np.asarray(indices, dtype=int))
+        spans = (indices[:, None] + np.arange(self._order)).ravel()
+        return np.unique(spans[(spans >= self._degree) & (spans < self._num_cvs)])
+
+    def span_versions(self):
+        '''
+        Returns a copy of the current version of each span, to know later
+        which spans changed since, with dirty_spans
+        '''
+        return self._span_versions.copy()
+
+    def dirty_spans(self, versions):
+        '''
+        Returns a mask of the knot spans that changed since the given versions
+        :param versions: versions of the spans, as returned by span_versions
+        :type  versions: np.array of int
+        :return type: np.array of bool, indexed by span
+        '''
+        return self._span_versions != versions
 
-    def compute_crv(self):
+    def compute_crv(self, by_length=False):
         ''' 
         Computes the curve at n parameters (with n=LOD). Running this will 
-        populate _out_pts, that we can use to draw the curve if needed
+        populate _out_pts and _out_tans, that we can use to draw the curve if
+        needed. When it's run again after some CVs moved, only the samples on
+        the dirty spans are recomputed
+        :param by_length: if True, the points are evenly spaced along the 
+                          curve, instead of evenly spaced in parameter. As 
+                          moving a single CV shifts all the params, every
+                          sample is recomputed then
+        :type  by_length: bool
         '''
-        self._out_pts = []
-        for i in xrange(self._LOD):
-            t = self._knots[self._num_knots-1] * i / (self._LOD-1.)
-            if i == self._LOD-1:
-                t -= .0001
-
-            out_point   = self.pt_at_param(t)
-            # out_tangent = self.tan_at_param(t)
+        if by_length:
+            ts = self.params_at_even_lengths(self._LOD)
+            self._samples = None
+            self._out_pts = list(self.pt_at_params(ts))
+            self._out_tans = list(self.tan_at_params(ts))
+            return self._out_pts
 
-            self._out_pts.append(out_point)
+        samples = self._samples
+        if samples is None:
+            ts = self._knots[self._num_knots-1] * np.arange(self._LOD) / (self._LOD-1.)
+            ts[-1] -= .0001
+            samples = self._samples = {'ts': ts, 'spans': self._find_spans(ts), 
+                                       'pts': self.pt_at_params(ts), 
+                                       'tans': self.tan_at_params(ts),
+                                       'versions': self.span_versions()}
+        else:
+            dirty = self.dirty_spans(samples['versions'])[samples['spans']]
+            if dirty.any():
+                samples['pts'][dirty] = self.pt_at_params(samples['ts'][dirty])
+                samples['tans'][dirty] = self.tan_at_params(samples['ts'][dirty])
+                samples['versions'] = self.span_versions()
+        self._out_pts = list(samples['pts'])
+        self._out_tans = list(samples['tans'])
 
         return self._out_pts
 
@@ -88,6 +191,78 @@ class NurbsCurve(object):
     
         return Eq1 + Eq2
 
+    def _find_span(self, t):
+        '''
+        Binary search of the knot span [knots[s], knots[s+1][ containing t.
+        The span is clamped to [degree, num_cvs-1], so a parameter sitting on
+        the last knot belongs to the last non-degenerate span
+        :param t: parameter
+        :type  t: float
+        :return : index s of the span. The CVs affecting t are s-degree..s
+        :return type: int
+        '''
+        span = bisect_right(self._knots, t) - 1
+        return min(max(span, self._degree), self._num_cvs - 1)
+
+    def _basis_funs(self, span, t, degree=None):
+        '''
+        Non-recursive Cox-de Boor : computes, in one triangular pass, the 
+        degree+1 basis functions that are non zero on the given span. 
+        (The NURBS Book, algorithm A2.2)
+        :param   span: knot span of t, as returned by _find_span
+        :type    span: int
+        :param      t: parameter
+        :type       t: float
+        :param degree: degree of the basis functions, the curve degree by 
+                       default (a lower degree is used by the derivatives)
+        :type  degree: int
+        :return : N[r] is the basis function of the CV span-degree+r
+        :return type: list of float
+        '''
+        if degree is None:
+            degree = self._degree
+        knots = self._knots
+        N = [1.] + [0.] * degree
+        left  = [0.] * (degree + 1)
+        right = [0.] * (degree + 1)
+        for j in xrange(1, degree + 1):
+            left[j]  = t - knots[span + 1 - j]
+            right[j] = knots[span + j] - t
+            saved = 0.
+            for r in xrange(j):
+                denominator = right[r + 1] + left[j - r]
+                temp = N[r] / denominator if denominator else 0.
+                N[r] = saved + right[r + 1] * temp
+                saved = left[j - r] * temp
+            N[j] = saved
+        return N
+
+    def _basis_funs_derived(self, span, t):
+        '''
+        First derivative of the degree+1 non zero basis functions, computed 
+        from the basis functions of degree-1 on the same span
+        :return : dN[r] is the derivative of the basis function of the CV 
+                  span-degree+r
+        :return type: list of float
+        '''
+        p = self._degree
+        dN = [0.] * (p + 1)
+        if p == 0:
+            return dN
+        knots = self._knots
+        # N_low[r] is the basis function of degree p-1 of the CV span-p+1+r
+        N_low = self._basis_funs(span, t, p - 1)
+        for r in xrange(p + 1):
+            if r > 0:
+                denominator = knots[span + r] - knots[span + r - p]
+                if denominator:
+                    dN[r] += p * N_low[r - 1] / denominator
+            if r < p:
+                denominator = knots[span + r + 1] - knots[span + r + 1 - p]
+                if denominator:
+                    dN[r] -= p * N_low[r] / denominator
+        return dN
+
     def pt_at_param(self, t):
         '''
         Returns the float3 position of a point at the given parameter t
@@ -96,31 +271,20 @@ class NurbsCurve(object):
         :return     : position of the point in 3D
         :return type: np.array()
         '''
-        # sum of the effect of all the CVs on the curve at the given parameter 
-        # to get the evaluated curve point
+        # thanks to the local support, only the degree+1 CVs of the span 
+        # have an effect on the curve at the given parameter
+        span = self._find_span(t)
+        N = self._basis_funs(span, t)
+        first_cv = span - self._degree
         numerator = np.zeros(3)
-        denominator = 0
-        for i in xrange(self._num_cvs):
-            # compute the effect of this point on the curve
-            N = self._CoxDeBoor(t, i, self._order, self._knots)
-            if N > .0001:
-                numerator += (self._weights[i] * self._cvs[i] * N)
-                denominator += (self._weights[i] * N)
+        denominator = 0.
+        for r in xrange(self._order):
+            i = first_cv + r
+            numerator += (self._weights[i] * self._cvs[i] * N[r])
+            denominator += (self._weights[i] * N[r])
 
         return numerator / denominator
 
-        '''
-        # If we don't need to have weighted values, we can use this equation
-        # to make thigns faster
-        for i in xrange(self._num_cvs):
-            val = self._CoxDeBoor(t, i, self._order, self._knots)
-            if val > .001:
-                # sum effect of CV on this part of the curve
-                out_pt[0] += val * self._cvs[i][0]
-                out_pt[1] += val * self._cvs[i][1]
-                out_pt[2] += val * self._cvs[i][2]
-        '''
-
     def tan_at_param(self, t):
         '''
         Returns the vector of the tangent at the given parameter t
@@ -129,33 +293,481 @@ class NurbsCurve(object):
         :return     : position of the point in 3D
         :return type: np.array()
         '''
+        span = self._find_span(t)
+        N = self._basis_funs(span, t)
+        dN = self._basis_funs_derived(span, t)
+        first_cv = span - self._degree
+
         numerator1A   = np.zeros(3)
-        numerator1B   = np.zeros(3)
         numerator2A   = np.zeros(3)
-        numerator2B   = np.zeros(3)
-        denominator   = 0
+        numerator2B   = 0.
+        denominator   = 0.
+        for r in xrange(self._order):
+            i = first_cv + r
+            denominator += (self._weights[i] * N[r])
+            # first equation
+            numerator1A += (self._weights[i] * self._cvs[i] * dN[r])
+            # second equation
+            numerator2A += (self._weights[i] * self._cvs[i] * N[r])
+            numerator2B += (self._weights[i] * dN[r])
+
+        eq1 = numerator1A * denominator / (denominator**2)
+        eq2 = numerator2A * numerator2B / (denominator**2)
+
+        return eq1 - eq2
+
+    def _find_spans(self, ts):
+        '''
+        Vectorized version of _find_span
+        :param ts: parameters
+        :type  ts: np.array of shape (N,)
+        :return : span index of each parameter
+        :return type: np.array of int, of shape (N,)
+        '''
+        spans = np.searchsorted(self._np_knots, ts, side='right') - 1
+        return np.clip(spans, self._degree, self._num_cvs - 1)
+
+    def _basis_funs_batch(self, spans, ts, degree=None):
+        '''
+        Vectorized version of _basis_funs : the triangular pass is done once, 
+        on all the parameters at the same time
+        :return : basis matrix, N[k, r] being the basis function of the CV 
+                  spans[k]-degree+r at the parameter ts[k]
+        :return type: np.array of shape (N, degree+1)
+        '''
+        if degree is None:
+            degree = self._degree
+        knots = self._np_knots
+        num_params = len(ts)
+        N = np.zeros([num_params, degree + 1])
+        N[:, 0] = 1.
+        left  = np.zeros([num_params, degree + 1])
+        right = np.zeros([num_params, degree + 1])
+        for j in xrange(1, degree + 1):
+            left[:, j]  = ts - knots[spans + 1 - j]
+            right[:, j] = knots[spans + j] - ts
+            saved = np.zeros(num_params)
+            for r in xrange(j):
+                denominator = right[:, r + 1] + left[:, j - r]
+                temp = np.divide(N[:, r], denominator, out=np.zeros(num_params), where=denominator != 0)
+                N[:, r] = saved + right[:, r + 1] * temp
+                saved = left[:, j - r] * temp
+            N[:, j] = saved
+        return N
+
+    def _basis_funs_derived_batch(self, spans, ts):
+        '''
+        Vectorized version of _basis_funs_derived
+        :return type: np.array of shape (N, degree+1)
+        '''
+        p = self._degree
+        num_params = len(ts)
+        dN = np.zeros([num_params, p + 1])
+        if p == 0:
+            return dN
+        knots = self._np_knots
+        N_low = self._basis_funs_batch(spans, ts, p - 1)
+        for r in xrange(p + 1):
+            if r > 0:
+                denominator = knots[spans + r] - knots[spans + r - p]
+                dN[:, r] += np.divide(p * N_low[:, r - 1], denominator, out=np.zeros(num_params), where=denominator != 0)
+            if r < p:
+                denominator = knots[spans + r + 1] - knots[spans + r + 1 - p]
+                dN[:, r] -= np.divide(p * N_low[:, r], denominator, out=np.zeros(num_params), where=denominator != 0)
+        return dN
+
+    def cvs_indices(self, spans):
+        '''
+        Returns the indices of the degree+1 CVs affecting each span, as a 
+        (N, degree+1) array
+        '''
+        return (spans - self._degree)[:, None] + np.arange(self._order)
+
+    def pt_at_params(self, ts):
+        '''
+        Vectorized version of pt_at_param
+        :param ts: parameters we query
+        :type  ts: np.array of shape (N,)
+        :return     : position of the points in 3D
+        :return type: np.array of shape (N, 3)
+        '''
+        ts = np.asarray(ts, dtype=float)
+        spans = self._find_spans(ts)
+        N = self._basis_funs_batch(spans, ts)
+        idx = self.cvs_indices(spans)
+        wN = self._weights[idx] * N
+        numerator = np.einsum('nr,nri->ni', wN, self._cvs[idx])
+        denominator = wN.sum(axis=1)
+
+        return numerator / denominator[:, None]
+
+    def tan_at_params(self, ts, spans=None):
+        '''
+        Vectorized version of tan_at_param
+        :param    ts: parameters we query
+        :type     ts: np.array of shape (N,)
+        :param spans: knot span of each parameter, found from the parameters
+                      if not given. A parameter on a knot is on the span at 
+                      its right, give the span at its left to get the tangent
+                      coming into the knot
+        :type  spans: np.array of int, of shape (N,)
+        :return     : tangent vectors
+        :return type: np.array of shape (N, 3)
+        '''
+        ts = np.asarray(ts, dtype=float)
+        spans = self._find_spans(ts) if spans is None else np.asarray(spans, dtype=int)
+        N = self._basis_funs_batch(spans, ts)
+        dN = self._basis_funs_derived_batch(spans, ts)
+        idx = self.cvs_indices(spans)
+        weights = self._weights[idx]
+        cvs = self._cvs[idx]
+        wN  = weights * N
+        wdN = weights * dN
+        denominator = wN.sum(axis=1)[:, None]
+        numerator1A = np.einsum('nr,nri->ni', wdN, cvs)
+        numerator2A = np.einsum('nr,nri->ni', wN, cvs)
+        numerator2B = wdN.sum(axis=1)[:, None]
+
+        return (numerator1A * denominator - numerator2A * numerator2B) / (denominator**2)
+
+    def basis_at_params(self, ts):
+        '''
+        Returns the span and the degree+1 non zero basis functions of each 
+        parameter, computed only once per unique parameter. The basis does not
+        depend on the CVs, so it can be cached as long as the knots and degree
+        don't change, and used with pt_at_params_from_basis
+        :param ts: parameters we query
+        :type  ts: np.array of shape (N,)
+        :return     : spans (N,) and basis functions (N, degree+1)
+        :return type: tuple of np.array
+        '''
+        unique_ts, inverse = np.unique(np.asarray(ts, dtype=float), return_inverse=True)
+        unique_spans = self._find_spans(unique_ts)
+        N = self._basis_funs_batch(unique_spans, unique_ts)
+        return unique_spans[inverse], N[inverse]
+
+    def pt_at_params_from_basis(self, cvs, spans, basis):
+        '''
+        Evaluates M curves sharing the knots, degree and weights of this 
+        curve, but each having its own CVs, from precomputed spans and basis
+        functions (see basis_at_params). No Cox-de Boor is done here, each 
+        point is only a weighted sum of degree+1 CVs.
+        :param   cvs: CVs of each curve
+        :type    cvs: np.array of shape (M, num_cvs, 3)
+        :param spans: span of each curve parameter
+        :type  spans: np.array of shape (M,)
+        :param basis: basis functions of each curve parameter
+        :type  basis: np.array of shape (M, degree+1)
+        :return     : position of the point on each curve
+        :return type: np.array of shape (M, 3)
+        '''
+        cvs = np.asarray(cvs, dtype=float)
+        idx = self.cvs_indices(spans)
+        return self.pt_at_params_from_window(cvs[np.arange(len(cvs))[:, None], idx], spans, basis)
+
+    def pt_at_params_from_window(self, window_cvs, spans, basis):
+        '''
+        Same as pt_at_params_from_basis, but each curve only gives the 
+        degree+1 CVs supporting the span of its parameter (see cvs_indices)
+        :param window_cvs: CVs of each curve, in the span of its parameter
+        :type  window_cvs: np.array of shape (M, degree+1, 3)
+        :param      spans: span of each curve parameter
+        :type       spans: np.array of shape (M,)
+        :param      basis: basis functions of each curve parameter
+        :type       basis: np.array of shape (M, degree+1)
+        :return     : position of the point on each curve
+        :return type: np.array of shape (M, 3)
+        '''
+        wN = self._weights[self.cvs_indices(spans)] * basis
+        numerator = np.einsum('mr,mri->mi', wN, window_cvs)
+
+        return numerator / wN.sum(axis=1)[:, None]
+
+    def pt_at_params_per_curve(self, cvs, ts):
+        '''
+        Evaluates M curves sharing the knots, degree and weights of this 
+        curve, but each having its own CVs, each at its own parameter. The
+        basis functions are computed only once per unique parameter.
+        :param cvs: CVs of each curve
+        :type  cvs: np.array of shape (M, num_cvs, 3)
+        :param  ts: parameter at which we evaluate each curve
+        :type   ts: np.array of shape (M,)
+        :return     : position of the point on each curve
+        :return type: np.array of shape (M, 3)
+        '''
+        spans, basis = self.basis_at_params(ts)
+        return self.pt_at_params_from_basis(cvs, spans, basis)
+
+    def closest_params(self, points, samples_per_span=8, max_iterations=20, tolerance=1e-6,
+                       max_halvings=12):
+        '''
+        Batched closest point on curve, for many points at once : each non 
+        degenerate knot span is split in segments (see _arc_length_segments),
+        so every knot is a sample, and the samples are queried with a 
+        spatial index. As the nearest sample may not be in the basin of the
+        closest point when the point is far from the curve, every segment 
+        that may hold a point closer than the nearest sample is a candidate,
+        unless the derivative of the distance shows it only holds a local 
+        maximum. The derivatives at the ends of a segment are taken on the 
+        span of the segment, so a kink on a knot is seen. All the candidates
+        are refined at once with safeguarded Newton iterations (see 
+        _refine_closest_params), then the closest one is kept per point
+        :param           points: points we want the closest point of
+        :type            points: np.array of shape (V, 3)
+        :param samples_per_span: number of segments per knot span
+        :type  samples_per_span: int
+        :param   max_iterations: max number of Newton iterations
+        :type    max_iterations: int
+        :param        tolerance: a parameter stops iterating when it moves of 
+                                 less than this
+        :type         tolerance: float
+        :param     max_halvings: max number of times a Newton step is halved
+        :type      max_halvings: int
+        :return     : params of shape (V,), and offsets (closest point -> 
+                      point) of shape (V, 3)
+        :return type: tuple of np.array
+        '''
+        points = np.asarray(points, dtype=float)
+        seg_starts, seg_ends, seg_spans = self._arc_length_segments(samples_per_span)
+        samples = np.append(seg_starts, seg_ends[-1])
+        num_segments = len(seg_starts)
+        samples_pos = self.pt_at_params(samples)
+        # tangent at both ends of each segment, on the span of the segment
+        start_tans = self.tan_at_params(seg_starts, seg_spans)
+        end_tans = self.tan_at_params(seg_ends, seg_spans)
+        seg_lengths = self._integrate_speed(seg_starts, seg_ends)
+        index = spatialIndex.SpatialIndex(samples_pos)
+        closest_samples, dists = index.query(points)
+
+        # the closest point is on a segment, one of its samples being at most
+        # one segment length farther than the closest point
+        point_indices, sample_indices = index.query_radius(points, dists + np.max(seg_lengths))
+        # the segments around these samples, that may hold a point closer 
+        # than the nearest sample : the distance to a point of a segment is 
+        # at least (distance to its start + distance to its end - its 
+        # length) / 2. A segment that starts going away from the point and 
+        # ends coming closer only holds a local maximum
+        seg_point_indices = np.repeat(point_indices, 2)
+        segments = np.stack([sample_indices - 1, sample_indices], axis=1).ravel()
+        valid = (segments >= 0) & (segments < num_segments)
+        seg_point_indices, segments = seg_point_indices[valid], segments[valid]
+        keys = np.unique(seg_point_indices * num_segments + segments)
+        seg_point_indices, segments = keys // num_segments, keys % num_segments
+        seg_points = points[seg_point_indices]
+        start_deltas = samples_pos[segments] - seg_points
+        end_deltas = samples_pos[segments+1] - seg_points
+        starts = np.sum(start_deltas * start_tans[segments], axis=1)
+        ends = np.sum(end_deltas * end_tans[segments], axis=1)
+        min_dists = .5 * (np.linalg.norm(start_deltas, axis=1) + np.linalg.norm(end_deltas, axis=1) - seg_lengths[segments])
+        valid = (min_dists <= dists[seg_point_indices]) & ((starts <= 0) | (ends >= 0))
+        seg_point_indices, segments = seg_point_indices[valid], segments[valid]
+        starts, ends = starts[valid], ends[valid]
+        # start where the derivative is 0 if it changes sign, in the middle 
+        # otherwise
+        sign_changes = (starts <= 0) & (ends >= 0)
+        weights = np.divide(starts, starts - ends, out=np.full(len(starts), .5), where=sign_changes & (starts != ends))
+        seg_guesses = samples[segments] + weights * (samples[segments+1] - samples[segments])
+
+        # the nearest sample is always a candidate
+        point_indices = np.concatenate([np.arange(len(points)), seg_point_indices])
+        first_guesses = np.concatenate([samples[closest_samples], seg_guesses])
+        lower = np.concatenate([samples[np.maximum(closest_samples - 1, 0)], samples[segments]])
+        upper = np.concatenate([samples[np.minimum(closest_samples + 1, num_segments)], samples[segments+1]])
+
+        params, sq_dists = self._refine_closest_params(points[point_indices], first_guesses, lower, upper,
+                                                       max_iterations, tolerance, max_halvings)
+        # keep the closest candidate of each point
+        order = np.lexsort((sq_dists, point_indices))
+        _, first = np.unique(point_indices[order], return_index=True)
+        params = params[order[first]]
+        return params, points - self.pt_at_params(params)
+
+    def _refine_closest_params(self, points, params, lower, upper, max_iterations, tolerance, max_halvings):
+        '''
+        Newton iterations on the squared distance of each point to the curve,
+        all the points at once. A step is only accepted if it brings the point
+        on curve closer, otherwise it is halved, and each param stays in its
+        [lower, upper] bracket. A point stops iterating when its step gets 
+        below the tolerance or when no step brings it closer
+        :param points: points we want the closest point of
+        :type  points: np.array of shape (N, 3)
+        :param params: first guess of each param
+        :type  params: np.array of shape (N,)
+        :param  lower: min of each param
+        :type   lower: np.array of shape (N,)
+        :param  upper: max of each param
+        :type   upper: np.array of shape (N,)
+        :return     : params (N,) and squared distances to the curve (N,)
+        :return type: tuple of np.array
+        '''
+        t_min = self._np_knots[self._degree]
+        t_max = self._np_knots[self._num_cvs]
+        h = 1e-4 * (t_max - t_min)  # to get the second derivative
+        params = params.copy()
+        sq_dists = np.sum((self.pt_at_params(params) - points)**2, axis=1)
+
+        active = np.arange(len(points))
+        for _ in xrange(max_iterations):
+            if not len(active):
+                break
+            ts = params[active]
+            pts = points[active]
+            delta = self.pt_at_params(ts) - pts
+            tangents = self.tan_at_params(ts)
+            ts_before = np.maximum(ts - h, t_min)
+            ts_after = np.minimum(ts + h, t_max)
+            second = (self.tan_at_params(ts_after) - self.tan_at_params(ts_before)) / (ts_after - ts_before)[:, None]
+            # f(t) = |C(t) - p|^2 / 2 : f' = delta.C', f'' = C'.C' + delta.C''
+            # where the curvature term makes f'' negative, use the 
+            # Gauss-Newton C'.C', that still gives a descent direction
+            gradients = np.sum(delta * tangents, axis=1)
+            gauss_newton = np.sum(tangents * tangents, axis=1)
+            hessians = gauss_newton + np.sum(delta * second, axis=1)
+            hessians = np.where(hessians > 0, hessians, gauss_newton)
+            steps = np.divide(gradients, hessians, out=np.zeros(len(ts)), where=hessians != 0)
+
+            current = sq_dists[active]
+            new_ts = ts.copy()
+            new_sq_dists = current.copy()
+            accepted = np.zeros(len(ts), dtype=bool)
+            for _ in xrange(max_halvings):
+                pending = np.flatnonzero(~accepted)
+                if not len(pending):
+                    break
+                trials = np.clip(ts[pending] - steps[pending], lower[active[pending]], upper[active[pending]])
+                trial_sq_dists = np.sum((self.pt_at_params(trials) - pts[pending])**2, axis=1)
+                closer = trial_sq_dists < current[pending]
+                new_ts[pending[closer]] = trials[closer]
+                new_sq_dists[pending[closer]] = trial_sq_dists[closer]
+                accepted[pending[closer]] = True
+                steps *= .5
+
+            params[active] = new_ts
+            sq_dists[active] = new_sq_dists
+            active = active[accepted & (np.abs(new_ts - ts) > tolerance)]
+
+        return params, sq_dists
+
+    def _arc_length_segments(self, segments_per_span):
+        '''
+        Splits each non degenerate knot span of the curve in segments
+        :return     : start param, end param and span index of each segment
+        :return type: tuple of np.array of shape (S,)
+        '''
+        spans = np.arange(self._degree, self._num_cvs)
+        spans = spans[self._np_knots[spans + 1] > self._np_knots[spans]]
+        fractions = np.arange(segments_per_span, dtype=float) / segments_per_span
+        span_starts = self._np_knots[spans]
+        span_lengths = self._np_knots[spans + 1] - span_starts
+        seg_starts = (span_starts[:, None] + span_lengths[:, None] * fractions).ravel()
+        seg_ends = seg_starts + np.repeat(span_lengths, segments_per_span) / segments_per_span
+        return seg_starts, seg_ends, np.repeat(spans, segments_per_span)
 
+    def _integrate_speed(self, starts, ends, gauss_order=5):
+        '''
+        Length of the curve between each start and end params, by Gauss-
+        Legendre integration of the norm of the tangent
+        :return type: np.array of shape (N,)
+        '''
+        nodes, gauss_weights = np.polynomial.legendre.leggauss(gauss_order)
+        half = (ends - starts) * .5
+        ts = ((starts + ends) * .5)[:, None] + half[:, None] * nodes
+        speeds = np.linalg.norm(self.tan_at_params(ts.ravel()), axis=1).reshape(ts.shape)
+        return np.dot(speeds, gauss_weights) * half
+
+    def arc_length_table(self, segments_per_span=16):
+        '''
+        Returns the arc length table of the curve : each knot span is split 
+        in segments, and the length of each segment is integrated with 
+        Gauss-Legendre. The table is cached, and when some CVs move, only 
+        the segments of the dirty spans are integrated again
+        :return     : start params (S+1,), cumulative lengths (S+1,)
+        :return type: tuple of np.array
+        '''
+        arc = self._arc_lengths
+        if arc is None or arc['segments_per_span'] != segments_per_span:
+            seg_starts, seg_ends, seg_spans = self._arc_length_segments(segments_per_span)
+            arc = self._arc_lengths = {'segments_per_span': segments_per_span, 
+                                       'starts': seg_starts, 'ends': seg_ends, 
+                                       'spans': seg_spans, 
+                                       'lengths': self._integrate_speed(seg_starts, seg_ends),
+                                       'versions': self.span_versions(), 
+                                       'table': None}
+        else:
+            dirty = self.dirty_spans(arc['versions'])[arc['spans']]
+            if dirty.any():
+                arc['lengths'][dirty] = self._integrate_speed(arc['starts'][dirty], arc['ends'][dirty])
+                arc['versions'] = self.span_versions()
+                arc['table'] = None
+        if arc['table'] is None:
+            table_params = np.append(arc['starts'], arc['ends'][-1:])
+            cumulative_lengths = np.append(0., np.cumsum(arc['lengths']))
+            arc['table'] = (table_params, cumulative_lengths)
+        return arc['table']
+
+    def length(self):
+        '''
+        Returns the length of the curve (a lookup in the arc length table)
+        '''
+        return self.arc_length_table()[1][-1]
+
+    def param_at_length(self, lengths):
+        '''
+        Returns the parameter at each given length along the curve : the 
+        segment is found in the arc length table, the parameter is linearly
+        interpolated in the segment, then corrected with one Newton step
+        :param lengths: lengths along the curve, from its start
+        :type  lengths: float or np.array of shape (N,)
+        :return     : parameter at each length
+        :return type: float or np.array of shape (N,)
+        '''
+        table_params, cumulative_lengths = self.arc_length_table()
+        lengths = np.clip(np.asarray(lengths, dtype=float), 0, cumulative_lengths[-1])
+        flat_lengths = np.atleast_1d(lengths)
+        segs = np.clip(np.searchsorted(cumulative_lengths, flat_lengths, side='right') - 1, 
+                       0, len(table_params) - 2)
+        seg_starts = table_params[segs]
+        seg_ends = table_params[segs + 1]
+        seg_lengths = cumulative_lengths[segs + 1] - cumulative_lengths[segs]
+        fractions = np.divide(flat_lengths - cumulative_lengths[segs], seg_lengths, 
+                              out=np.zeros(len(segs)), where=seg_lengths != 0)
+        ts = seg_starts + fractions * (seg_ends - seg_starts)
+
+        # one Newton step on L(t) - length = 0, with L'(t) = |C'(t)|
+        errors = cumulative_lengths[segs] + self._integrate_speed(seg_starts, ts) - flat_lengths
+        speeds = np.linalg.norm(self.tan_at_params(ts), axis=1)
+        steps = np.divide(errors, speeds, out=np.zeros(len(ts)), where=speeds != 0)
+        ts = np.clip(ts - steps, seg_starts, seg_ends)
+
+        return ts.reshape(lengths.shape) if lengths.ndim else ts[0]
+
+    def params_at_even_lengths(self, num_samples):
+        '''
+        Returns num_samples parameters, evenly spaced along the curve
+        '''
+        return self.param_at_length(np.linspace(0, self.length(), num_samples))
+
+    def _pt_at_param_recursive(self, t):
+        '''
+        Reference implementation of pt_at_param, using the recursive 
+        _CoxDeBoor on every CV. Way slower, only kept to check the span-local
+        evaluation against it
+        '''
+        numerator = np.zeros(3)
+        denominator = 0
         for i in xrange(self._num_cvs):
             N = self._CoxDeBoor(t, i, self._order, self._knots)
-            dN = self._CoxDeBoorDerived(t, i, self._order, self._knots)
-
             if N > .0001:
+                numerator += (self._weights[i] * self._cvs[i] * N)
                 denominator += (self._weights[i] * N)
-                # first equation
-                numerator1A += (self._weights[i] * self._cvs[i] * dN)
-                numerator1B += (self._weights[i] * N)
-                # second equation
-                numerator2A += (self._weights[i] * self._cvs[i] * N)
-                numerator2B += (self._weights[i] * dN)
-
-        eq1 = (numerator1A * numerator1B) / (denominator**2)
-        eq2 = (numerator2A * numerator2B) / (denominator**2)
 
-        return eq1 - eq2
+        return numerator / denominator
 
     def _CoxDeBoorDerived(self, t, i, k, knots):
         ''' 
-        Derivated function of the _CoxDeBoor algorithm, used only for the tangent
+        Derivated function of the _CoxDeBoor algorithm. No longer used by 
+        tan_at_param (see _basis_funs_derived), and note that it scales the 
+        derivative by the order k instead of the degree k-1
         :param t: parameter
         :type  t: float
         :param i: index of the CV we treat currently
@@ -193,3 +805,67 @@ class NurbsCurve(object):
         '''
         cmds.curve(n='mayaCrv', d=self._degree, p=self._cvs, k=self._knots[1:-1])
         cmds.curve(n='myCrv', d=1, p=self._out_pts)
+
+
+def check_parity(num_params=50, tolerance=1e-3):
+    '''
+    Compares the span-local basis evaluation with the recursive _CoxDeBoor
+    on the curve of the NurbsCurve docstring, the tangent with a finite 
+    difference of the position, the batched evaluations with the scalar 
+    ones, the closest params and the arc length with a dense sampling of 
+    the curve, and the partial updates when a CV moves with a new curve
+    '''
+    crv = NurbsCurve(points=([10,10,0], [5,10,2], [-5,5,0], [10,5,-2], [4,10,0], [4,5,2], [8,1,0]), 
+                     knots=[0,0,0,0,1,2,3,4,4,4,4], degree=3)
+    dt = 1e-6
+    for i in xrange(num_params):
+        t = 4. * i / num_params
+        pt = crv.pt_at_param(t)
+        ref_pt = crv._pt_at_param_recursive(t)
+        assert np.allclose(pt, ref_pt, atol=tolerance), (t, pt, ref_pt)
+        tan = crv.tan_at_param(t)
+        ref_tan = (crv.pt_at_param(t + dt) - crv.pt_at_param(t - dt)) / (2 * dt)
+        assert np.allclose(tan, ref_tan, atol=tolerance), (t, tan, ref_tan)
+    ts = 4. * np.arange(num_params) / num_params
+    assert np.allclose(crv.pt_at_params(ts), [crv.pt_at_param(t) for t in ts])
+    assert np.allclose(crv.tan_at_params(ts), [crv.tan_at_param(t) for t in ts])
+    offsets = np.arange(num_params * 3, dtype=float).reshape(num_params, 1, 3)
+    crvs_pts = crv.pt_at_params_per_curve(crv._cvs[None] + offsets, ts)
+    assert np.allclose(crvs_pts, crv.pt_at_params(ts) + offsets[:, 0])
+    dense_ts = np.linspace(0, 4, 40001)
+    dense_pts = crv.pt_at_params(dense_ts)
+    points = crv.pt_at_params(ts) + np.random.RandomState(0).uniform(-.5, .5, (num_params, 3))
+    params, offsets = crv.closest_params(points)
+    ref_params = dense_ts[np.argmin(np.linalg.norm(points[:, None] - dense_pts[None], axis=2), axis=1)]
+    assert np.allclose(params, ref_params, atol=tolerance), np.abs(params - ref_params).max()
+    assert np.allclose(points - offsets, crv.pt_at_params(params))
+    # far from the curve, the nearest sample may not be in the basin of the
+    # closest point : compare the distances, as the params may nearly tie.
+    # Also on non uniform knots, and on a polyline, kinked on its knots
+    rng = np.random.RandomState(0)
+    non_uniform_crv = NurbsCurve(points=rng.uniform(-5, 5, (9, 3)), 
+                                 knots=[0,0,0,0,.98,2.28,3.01,3.62,3.92,4,4,4,4], degree=3)
+    polyline = NurbsCurve(points=rng.uniform(-5, 5, (7, 3)), knots=[0,0,.3,.5,1.9,2.2,3.5,4,4], degree=1)
+    for check_crv, spreads in ((crv, (2., 5.)), (non_uniform_crv, (.1, 2.)), (polyline, (.1, 2.))):
+        check_dense_pts = check_crv.pt_at_params(dense_ts)
+        for spread in spreads:
+            points = check_crv.pt_at_params(np.repeat(ts, 6)) + rng.normal(0, spread, (num_params * 6, 3))
+            params, offsets = check_crv.closest_params(points)
+            ref_dists = np.min(np.linalg.norm(points[:, None] - check_dense_pts[None], axis=2), axis=1)
+            dists = np.linalg.norm(offsets, axis=1)
+            assert np.all(dists <= ref_dists + 1e-6), (check_crv._degree, spread, np.max(dists - ref_dists))
+            assert np.allclose(points - offsets, check_crv.pt_at_params(params))
+    ref_lengths = np.append(0., np.cumsum(np.linalg.norm(np.diff(dense_pts, axis=0), axis=1)))
+    assert abs(crv.length() - ref_lengths[-1]) < tolerance, (crv.length(), ref_lengths[-1])
+    even_lengths = np.interp(crv.params_at_even_lengths(num_params), dense_ts, ref_lengths)
+    assert np.allclose(even_lengths, np.linspace(0, ref_lengths[-1], num_params), atol=tolerance)
+    crv.compute_crv()
+    dirty_spans = crv.set_cv(0, [12, 10, 0])
+    assert list(dirty_spans) == [3], dirty_spans
+    moved_crv = NurbsCurve(points=crv.cvs, knots=crv._knots, degree=crv._degree)
+    assert np.allclose(crv.compute_crv(), moved_crv.compute_crv())
+    assert np.allclose(crv.length(), moved_crv.length())
+
+
+if __name__ == '__main__':
+    check_parity()
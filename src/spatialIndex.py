@@ -0,0 +1,88 @@
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None  # scipy is not always available in maya, use brute force
+
+
+class SpatialIndex(object):
+    '''
+    Nearest neighbour queries of many points against a fixed set of points
+    (joints, curve samples...). Uses a KD-tree when scipy is available,
+    otherwise the distances are computed by chunks of query points, each
+    chunk being a single array operation.
+
+    index = SpatialIndex(points=[[0,0,0], [1,0,0], [2,0,0]])
+    closest_idx, dists = index.query([[.9,0,0], [5,0,0]])
+    '''
+    def __init__(self, points, chunk_size=2**20):
+        '''
+        :param     points: points we'll look for the closest one
+        :type      points: array(float3)
+        :param chunk_size: max number of distances computed at once by the
+                           brute force query, to bound the memory
+        :type  chunk_size: int
+        '''
+        self._points = np.asarray(points, dtype=float)
+        self._chunk_size = chunk_size
+        self._tree = cKDTree(self._points) if cKDTree is not None else None
+
+    def query(self, query_points):
+        '''
+        Returns, for each query point, the index of the closest point and
+        the distance to it
+        :param query_points: points we query
+        :type  query_points: array of shape (N, 3)
+        :return     : indices (N,) and distances (N,)
+        :return type: tuple of np.array
+        '''
+        query_points = np.asarray(query_points, dtype=float)
+        if self._tree is not None:
+            dists, indices = self._tree.query(query_points)
+            return indices, dists
+
+        num_queries = len(query_points)
+        indices = np.zeros(num_queries, dtype=int)
+        dists = np.zeros(num_queries)
+        step = max(1, self._chunk_size // max(1, len(self._points)))
+        for start in xrange(0, num_queries, step):
+            chunk = query_points[start:start+step]
+            sq_dists = np.sum((chunk[:, None] - self._points[None])**2, axis=2)
+            closest = np.argmin(sq_dists, axis=1)
+            indices[start:start+step] = closest
+            dists[start:start+step] = np.sqrt(sq_dists[np.arange(len(chunk)), closest])
+        return indices, dists
+
+    def query_radius(self, query_points, radii):
+        '''
+        Returns all the (query point, point) pairs closer than the radius of
+        the query point
+        :param query_points: points we query
+        :type  query_points: array of shape (N, 3)
+        :param        radii: radius of each query point
+        :type         radii: array of shape (N,)
+        :return     : query indices (P,) and point indices (P,) of the pairs,
+                      sorted by query index
+        :return type: tuple of np.array
+        '''
+        query_points = np.asarray(query_points, dtype=float)
+        radii = np.broadcast_to(np.asarray(radii, dtype=float), (len(query_points),))
+        if self._tree is not None:
+            neighbours = self._tree.query_ball_point(query_points, radii)
+            counts = np.array([len(indices) for indices in neighbours], dtype=int)
+            indices = np.fromiter((i for indices in neighbours for i in indices), dtype=int, count=counts.sum())
+            return np.repeat(np.arange(len(query_points)), counts), indices
+
+        query_indices = []
+        indices = []
+        step = max(1, self._chunk_size // max(1, len(self._points)))
+        for start in xrange(0, len(query_points), step):
+            chunk = query_points[start:start+step]
+            sq_dists = np.sum((chunk[:, None] - self._points[None])**2, axis=2)
+            chunk_queries, chunk_indices = np.nonzero(sq_dists <= radii[start:start+step, None]**2)
+            query_indices.append(chunk_queries + start)
+            indices.append(chunk_indices)
+        if not indices:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        return np.concatenate(query_indices), np.concatenate(indices)
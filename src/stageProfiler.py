@@ -0,0 +1,121 @@
+import logging
+from collections import OrderedDict, deque
+from timeit import default_timer
+
+
+logger = logging.getLogger(__name__)
+
+# max number of stages kept for the log of an evaluation, when
+# end_evaluation() isn't called (the core used outside of the node)
+MAX_EVALUATION_STAGES = 1000
+
+
+class _NoStage(object):
+    '''
+    Context manager doing nothing, returned when the profiler is disabled
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        self._profiler._depth += 1
+        self._start = default_timer()
+        return self
+
+    def __exit__(self, *args):
+        seconds = default_timer() - self._start
+        self._profiler._depth -= 1
+        self._profiler.add(self._name, seconds)
+        return False
+
+
+class StageProfiler(object):
+    '''
+    Records the wall time and the number of calls of named stages. When
+    disabled, stage() returns a shared context manager doing nothing, so
+    the instrumented code costs about nothing.
+
+    profiler = StageProfiler(enabled=True)
+    with profiler.stage('closest_points'):
+        ...
+    profiler.stats()  # {'closest_points': {'calls': 1, 'seconds': ..., 'last_seconds': ...}}
+    '''
+    def __init__(self, enabled=False, log_evaluations=False):
+        '''
+        :param         enabled: True to record the stages
+        :type          enabled: bool
+        :param log_evaluations: True to log the stages of each evaluation,
+                                see end_evaluation()
+        :type  log_evaluations: bool
+        '''
+        self.enabled = enabled
+        self.log_evaluations = log_evaluations
+        self._stages = OrderedDict()  # name -> [calls, seconds, last seconds]
+        # (name, seconds, depth) of the current evaluation, depth being the
+        # number of stages running around it
+        self._evaluation = deque(maxlen=MAX_EVALUATION_STAGES)
+        self._depth = 0
+
+    def stage(self, name):
+        '''
+        Returns a context manager timing the code it runs as the stage name
+        :type name: str
+        '''
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name)
+
+    def add(self, name, seconds):
+        '''
+        Records a call of the stage name, that took seconds. Does nothing
+        when the profiler is disabled
+        '''
+        if not self.enabled:
+            return
+        stage = self._stages.get(name)
+        if stage is None:
+            stage = self._stages[name] = [0, 0., 0.]
+        stage[0] += 1
+        stage[1] += seconds
+        stage[2] = seconds
+        if self.log_evaluations:
+            self._evaluation.append((name, seconds, self._depth))
+
+    def end_evaluation(self, label):
+        '''
+        Logs the stages recorded since the last evaluation, if
+        log_evaluations is on. The total only counts the outermost stages, 
+        the nested ones being part of them
+        :param label: name of what was evaluated, usually the node name
+        :type  label: str
+        '''
+        if self._evaluation:
+            total = sum(seconds for _, seconds, depth in self._evaluation if depth == 0)
+            logger.info('%s : %.3fms (%s)', label, 1000 * total,
+                        ', '.join('%s %.3fms' % (name, 1000 * seconds) for name, seconds, _ in self._evaluation))
+        self._evaluation.clear()
+
+    def reset(self):
+        self._stages.clear()
+        self._evaluation.clear()
+
+    def stats(self):
+        '''
+        Returns the number of calls, the total time and the time of the last
+        call of each stage, in seconds
+        :return type: OrderedDict
+        '''
+        return OrderedDict((name, {'calls': calls, 'seconds': seconds, 'last_seconds': last_seconds})
+                           for name, (calls, seconds, last_seconds) in self._stages.items())
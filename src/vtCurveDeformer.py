@@ -3,13 +3,20 @@ import maya.OpenMayaMPx    as omMpx
 import maya.OpenMayaAnim   as omAnim
 import maya.OpenMayaRender as OpenMayaRender
 import maya.OpenMayaUI     as OpenMayaUI
+import multiprocessing
+import os
 import sys
+import weakref
 import numpy as np
 from math import sqrt
 from random import randint
 
 #sys.path.insert(0, '/Users/fruity/Documents/_dev/fToolbox/vtPlugins/vtCurveDeformer/src/')
 import nurbsCurve;reload(nurbsCurve)
+import spatialIndex;reload(spatialIndex)
+import bindData;reload(bindData)
+import stageProfiler;reload(stageProfiler)
+import curveDeformerCore;reload(curveDeformerCore)
 
 pluginName = 'curveDeformer'
 pluginId = om.MTypeId(0x1272C9)
@@ -35,6 +42,72 @@ cmds.refresh()
 cmds.setAttr(df + '.initialize', False)
 '''
 
+# every curveDeformer node, to query their stats
+_instances = weakref.WeakSet()
+
+
+def get_stats(node_name=None):
+    '''
+    Returns the wall time and number of calls of each stage recorded (when
+    the profile attribute is on), and the memory used by the bind data, of
+    each curveDeformer node :
+    vtCurveDeformer.get_stats()['curveDeformer1']['stages']['deform.vertices']['seconds']
+    :param node_name: only returns the stats of this node
+    :type  node_name: str
+    :return     : stats of each node (see CurveDeformerCore.get_stats)
+    :return type: dict
+    '''
+    stats = {}
+    for node in list(_instances):
+        name = om.MFnDependencyNode(node.thisMObject()).name()
+        if node_name is None or name == node_name:
+            stats[name] = node._core.get_stats()
+    return stats
+
+
+def check_closest_params(mesh_name, base_crv_name, tolerance=1e-4):
+    '''
+    Compares the closest params computed by NurbsCurve.closest_params 
+    (used at init) with the ones of MFnNurbsCurve.closestPoint, from a 
+    maya session
+    :param     mesh_name: name of the deformed mesh
+    :type      mesh_name: str
+    :param base_crv_name: name of the base curve
+    :type  base_crv_name: str
+    '''
+    selection = om.MSelectionList()
+    selection.add(mesh_name)
+    selection.add(base_crv_name)
+    dpMesh = om.MDagPath()
+    dpBaseCrv = om.MDagPath()
+    selection.getDagPath(0, dpMesh)
+    selection.getDagPath(1, dpBaseCrv)
+    fnBaseCrv = om.MFnNurbsCurve(dpBaseCrv)
+
+    points = om.MPointArray()
+    om.MFnMesh(dpMesh).getPoints(points, om.MSpace.kWorld)
+    positions = np.array([[points[i].x, points[i].y, points[i].z] for i in xrange(points.length())])
+    util = om.MScriptUtil()
+    util.createFromDouble(0.)
+    uPtr = util.asDoublePtr()
+    maya_params = np.zeros([points.length()])
+    for i in xrange(points.length()):
+        fnBaseCrv.closestPoint(points[i], uPtr, 1e-6, om.MSpace.kWorld)
+        maya_params[i] = om.MScriptUtil.getDouble(uPtr)
+
+    cvs = om.MPointArray()
+    fnBaseCrv.getCVs(cvs, om.MSpace.kWorld)
+    maya_knots = om.MDoubleArray()
+    fnBaseCrv.getKnots(maya_knots)
+    knots = [maya_knots[i] for i in xrange(maya_knots.length())]
+    knots = [knots[0]] + knots + [knots[-1]]
+    base_crv = nurbsCurve.NurbsCurve(points=[[cvs[i].x, cvs[i].y, cvs[i].z] for i in xrange(cvs.length())],
+                                     knots=knots, degree=fnBaseCrv.degree())
+    params, _ = base_crv.closest_params(positions, tolerance=tolerance*.01)
+    errors = np.abs(params - maya_params)
+    assert errors.max() <= tolerance, (errors.argmax(), errors.max())
+
+
 class curveDeformer(omMpx.MPxDeformerNode):
     '''
     From what I understood, we have roughly 5 steps:
@@ -55,6 +128,9 @@ class curveDeformer(omMpx.MPxDeformerNode):
     - knowing the direction in which we need to push (or pull) the CV, we 
       multiply this direction by Tau and the CV weight
     - finally, we get the point at parameter for the current vtx, on the fix crv
+    All the maths are done in curveDeformerCore, that doesn't depend on maya.
+    This node only reads its inputs as arrays, and writes the deformed 
+    positions.
     '''
     aInit      = om.MObject()
     aInCrv     = om.MObject()
@@ -63,22 +139,50 @@ class curveDeformer(omMpx.MPxDeformerNode):
     aCps       = om.MObject()
     aMatrixJoint  = om.MObject()
     aMatrixJoints = om.MObject()
+    aBindCacheDir  = om.MObject()
+    aNumThreads    = om.MObject()
+    aChunkSize     = om.MObject()
+    aRotationBlend = om.MObject()
+    aMaxInfluences = om.MObject()
+    aProfile       = om.MObject()
+    aLogProfile    = om.MObject()
 
     if om.MGlobal.apiVersion() < 201600:
         _input = omMpx.cvar.MPxDeformerNode_input # note: input is a python builtin
         inputGeom = omMpx.cvar.MPxDeformerNode_inputGeom
         envelope = omMpx.cvar.MPxDeformerNode_envelope
+        weightList = omMpx.cvar.MPxDeformerNode_weightList
+        weights = omMpx.cvar.MPxDeformerNode_weights
         outputGeom = omMpx.cvar.MPxDeformerNode_outputGeom
     else:
         _input = omMpx.cvar.MPxGeometryFilter_input # note: input is a python builtin
         inputGeom = omMpx.cvar.MPxGeometryFilter_inputGeom
         envelope = omMpx.cvar.MPxGeometryFilter_envelope
+        weightList = omMpx.cvar.MPxGeometryFilter_weightList
+        weights = omMpx.cvar.MPxGeometryFilter_weights
         outputGeom = omMpx.cvar.MPxGeometryFilter_outputGeom
     
     def __init__(self):
         omMpx.MPxDeformerNode.__init__(self)
-   
+        self._core = curveDeformerCore.CurveDeformerCore()
+        self.num_dag_matrix_reads = 0  # joint matrices read from the DAG during the last evaluation
+        self._bind_miss = None  # (bind cache dir, rotation blend, max influences) with no bind file
+        self._initializing = False  # initialize was on at the last bind
+        _instances.add(self)
+
     def deform(self, data, itGeo, localToWorldMatrix, geomIndex):
+        # the profiler records the time of each stage of the node and the
+        # core, and logs them after each evaluation if logProfile is on
+        profiler = self._core.profiler
+        profiler.enabled = data.inputValue(self.aProfile).asBool()
+        profiler.log_evaluations = profiler.enabled and data.inputValue(self.aLogProfile).asBool()
+        with profiler.stage('node.evaluation'):
+            self.evaluate(data, itGeo, localToWorldMatrix, geomIndex)
+        if profiler.log_evaluations:
+            profiler.end_evaluation(om.MFnDependencyNode(self.thisMObject()).name())
+
+    def evaluate(self, data, itGeo, localToWorldMatrix, geomIndex):
+        self.num_dag_matrix_reads = 0
         # 
         # get input datas
         hDeformedMeshArray = data.outputArrayValue(curveDeformer._input)
@@ -92,6 +196,14 @@ class curveDeformer(omMpx.MPxDeformerNode):
         # ---------------------------------------------------------------------- 
         # get the init state
         initialize = data.inputValue(self.aInit).asBool()
+        bind_cache_dir = data.inputValue(self.aBindCacheDir).asString()
+        rotation_blend = data.inputValue(self.aRotationBlend).asShort()
+        max_influences = data.inputValue(self.aMaxInfluences).asInt()
+
+        # parallel evaluation, 0 thread meaning one per core
+        num_threads = data.inputValue(self.aNumThreads).asInt()
+        self._core.num_threads = num_threads if num_threads > 0 else multiprocessing.cpu_count()
+        self._core.chunk_size = data.inputValue(self.aChunkSize).asInt()
 
         # get the in curve
         oCrv = data.inputValue(curveDeformer.aInCrv).asNurbsCurve()
@@ -104,11 +216,7 @@ class curveDeformer(omMpx.MPxDeformerNode):
         fnBaseCrv = om.MFnNurbsCurve(oBaseCrv)
 
         # get general curve infos
-        degree = fnCrv.degree()
-        dummy = om.MDoubleArray()
-        fnCrv.getKnots(dummy)
-        knots = [dummy[i] for i in xrange(dummy.length())]
-        knots = [knots[0]] + knots + [knots[-1]]
+        degree, knots = self.get_degree_and_knots(fnCrv)
 
         # envelope
         envelopeHandle = data.inputValue(curveDeformer.envelope)
@@ -148,113 +256,141 @@ class curveDeformer(omMpx.MPxDeformerNode):
         elif len(weights) > num_cvs:
             weights = weights[:num_cvs]
 
+        # get the position of all the vertices at once
+        with self._core.profiler.stage('node.read_positions'):
+            positions = self.get_np_positions(itGeo)
+            paint_weights = self.get_paint_weights(data, geomIndex, len(positions))
+
         # ----------------------------------------------------------------------
         #                               INITIALIZE
         # ---------------------------------------------------------------------- 
         # at init stage, we do : 
         # 1 - get the skinCluster of the curve
         # 2 - get the matrices / weights of the joints influencing the SC
-        # 3 - get an average matrix for each CP
-        # 4 - get the offset vector delta between closest point on curve 
-        #     and current vertex
-        # 5 - get the 3 closest joints for each vertex and compute Tau
-        # 6 - assign a weight for each offset CV based on the distance with the vtx
-        if initialize:
-            # 1 - get the skinCluster attached to the curve and the dag path
-            fnSc, dpInCrv = self.get_skin_cluster()
-            # 2 - get the bones and weights
-            self._weights = self.get_skin_weights(fnSc, dpInCrv)
-            # 3 - compute the base transformation matrix for each CV
-            self._dpJoints = om.MDagPathArray()
-            fnSc.influenceObjects(self._dpJoints)
-            self._base_mats_per_cv = self.get_mat_per_cv(self._dpJoints, cvs_base_array)
-            # 4 - compute offset vector and parameter
-            self._pOffsets, self._params = self.get_offsets_and_params(itGeo, fnBaseCrv)
-            # 5 - get the 3 closest joints for each vertex, to compute Tau parameter later. This is a list of the 3 closest joint indices, for each vertex
-            self._closest_jts_idx = self.get_3_closest_jts_per_vertex(itGeo, self.jts_pos)
-            P, O, Q = self._closest_jts_idx[itGeo.index()]
-            # 6 - assign a weight to each offset cv, based on inv dist from O
-            self._dist_CV_weights = self.inverse_distance_weighting(O, cvs_base_array)
-            # 7 - set the direction of the offset CVs method (in deform)
-            self._directions_mat  = self.set_offset_direction(itGeo, self._pOffsets, cvs_base_array, self._base_mats_per_cv)
-            # 8 - get the Tau values by default to remap them efficiently later
-            self._default_taus = self.get_default_taus(itGeo, P, O, Q)
+        # 3 - compute everything else in the core (offset vector delta 
+        #     between closest point on curve and current vertex, average 
+        #     matrix for each CP, 3 closest joints and Tau for each vertex,
+        #     weight and direction of each offset CV...)
+        # When the scene is reopened (or the plugin reloaded), the bind data 
+        # is read from the bind cache directory, if there's a file saved for
+        # the same base mesh, base curve, bind pose, skin weights and number
+        # of Tau joints. When there's none, it isn't looked for again until 
+        # the attributes choosing the file change. The file is only saved 
+        # when initialize is turned on, not at each evaluation while it's on
+        bind_request = (bind_cache_dir, rotation_blend, max_influences)
+        if initialize or (bind_cache_dir and not self._core.is_initialized and bind_request != self._bind_miss):
+            save = initialize and not self._initializing
+            self.bind(positions, fnBaseCrv, cvs_base_array, bind_cache_dir, initialize, rotation_blend, 
+                      max_influences, save)
+        self._initializing = initialize
 
         # ----------------------------------------------------------------------
         #                               DEFORM
         # ---------------------------------------------------------------------- 
         # to rebuild the curve, we need to get 2 things :
         # - the offset between the current vertex and the closest point 
-        #   on curve computed in the initialize and stored in self._pOffsets
+        #   on curve computed in the initialize
         # - the transformationMatrix between all the CVs of the base_crv and the crv
         # once we have that, we just add the offset to the transformMatrix to get the 
         # virtual cvs of the offset curve
-        else:
-            out_positions = om.MPointArray()
-            while not itGeo.isDone():
-                # compute the Tau multiplier
-                P, O, Q = self._closest_jts_idx[itGeo.index()]
-                offset_cvs = []
-                weighted_matrices = []
-                # self._np_jts_pos()
-                for i in xrange(cvs_array.length()):
-                    # ----------------------------------------
-                    # get the weighted matrix
-                    euler_per_joint = []
-                    for j in xrange(self._dpJoints.length()):
-                        inclusive_mat = self._dpJoints[j].inclusiveMatrix()
-                        euler_per_joint.append(om.MTransformationMatrix(inclusive_mat).rotation().asEulerRotation())
-
-                    # - get the offset matrix (cv * base_cv. The baseCV mat has
-                    #   a position 0,0,0, so with only 1 matrix mult, we get the 
-                    #   offset in the correct position in space instead of 
-                    #   having it in the origin
-                    weighted_matrix      = self.get_weighted_matrix(euler_per_joint, self._weights[i], cvs_array[i])
-                    weighted_base_matrix = self._base_mats_per_cv[i]
-                    offset_mat = weighted_matrix * weighted_base_matrix.inverse()
-                    weighted_matrices.append(weighted_matrix)
-
-                    # adds the delta
-                    # It is super important to work with MPoints and not 
-                    # MVectors for the deltas, as an MPoint*MMatrix gives 
-                    # different result from MVector*MMatrix
-                    delta = self._pOffsets[itGeo.index()]
-                    final_pos = delta * offset_mat
-
-                    # stores the final cv position
-                    offset_cvs.append([final_pos.x, final_pos.y, final_pos.z])
-
-                # fix with Tau
-                # do = 99
-                # if itGeo.index() == do:
-                tau = self.get_tau(P, O, Q, om.MPoint(itGeo.position()))
-                default_tau = self._default_taus[itGeo.index()]
-                tau = tau - default_tau
-                # print 'tau -->', tau
-                # print 'weight -->', self._dist_CV_weights
-                # tau = self._remap(tau, default_tau-.5, default_tau+.5, -1., 1.)
-
-                # get the CVs by distance
-                # weighted_cvs = self._dist_CV_weights[itGeo.index()]
-                weighted_cvs = self._dist_CV_weights
-                offset_cvs = self.offset_CVs_by_tau(itGeo.position(), 
-                                                    offset_cvs, 
-                                                    weighted_matrices, 
-                                                    tau, 
-                                                    weighted_cvs,
-                                                    self._directions_mat[itGeo.index()])
-
-                # now we have the new CP positions, compute the curve
-                crv = nurbsCurve.NurbsCurve(points=offset_cvs, knots=knots, degree=degree, weights=weights)
-                new_pos = crv.pt_at_param(self._params[itGeo.index()])
-
-
-                out_positions.append(om.MPoint(new_pos[0], new_pos[1], new_pos[2]))
-
-                itGeo.next()
-
-            itGeo.setAllPositions(out_positions)
+        if not initialize:
+            if not self._core.is_initialized:
+                return
+            # the joints don't move during the evaluation, read them only once
+            with self._core.profiler.stage('node.read_joints'):
+                jts_mats = self.get_joints_state(self._dpJoints, self._core.bind_data.skin_weights.influences)
+            new_positions = self._core.deform(positions, 
+                                              self.MPointArray_to_np(cvs_array), 
+                                              knots, degree, jts_mats, 
+                                              self.jts_pos, weights, env, 
+                                              paint_weights)
+
+            with self._core.profiler.stage('node.write_positions'):
+                out_positions = om.MPointArray()
+                for new_pos in new_positions:
+                    out_positions.append(om.MPoint(new_pos[0], new_pos[1], new_pos[2]))
+                itGeo.setAllPositions(out_positions)
     
+    def bind(self, positions, fnBaseCrv, cvs_base_array, bind_cache_dir, initialize, rotation_blend, 
+             max_influences, save=True):
+        '''
+        Gives the bind data to the core. When initialize is on, it is always
+        computed, and saved in the bind cache directory if there's one and 
+        save is on. Otherwise, it is only loaded from the bind cache 
+        directory, and a warning is displayed when there's no file for the 
+        current inputs
+        :param      positions: position of each vertex of the base mesh
+        :type       positions: np.array of shape (V, 3)
+        :param bind_cache_dir: directory of the bind data files, or ''
+        :type  bind_cache_dir: str
+        :param     initialize: True to compute the bind data
+        :type      initialize: bool
+        :param rotation_blend: how the joint rotations are blended for each CV
+        :type  rotation_blend: int
+        :param max_influences: max number of joints per CV, 0 for all of them
+        :type  max_influences: int
+        :param           save: False to not save the computed bind data
+        :type            save: bool
+        '''
+        profiler = self._core.profiler
+        # 1 - get the skinCluster attached to the curve and the dag path
+        with profiler.stage('node.skin_cluster'):
+            fnSc, dpInCrv = self.get_skin_cluster()
+        # 2 - get the bones and weights
+        with profiler.stage('node.skin_weights'):
+            skin_weights = self.get_skin_weights(fnSc, dpInCrv, max_influences)
+        self._dpJoints = om.MDagPathArray()
+        fnSc.influenceObjects(self._dpJoints)
+        base_degree, base_knots = self.get_degree_and_knots(fnBaseCrv)
+        base_cvs = self.MPointArray_to_np(cvs_base_array)
+
+        path = None
+        if bind_cache_dir and (save or not initialize):
+            # the Tau joints animate, they're not in the key
+            with profiler.stage('node.bind_key'):
+                key = bindData.bind_key(positions, base_cvs, base_knots, base_degree, 
+                                        self.get_bind_pose(fnSc, self._dpJoints), skin_weights, 
+                                        rotation_blend)
+            path = os.path.join(bind_cache_dir, key + bindData.FILE_EXTENSION)
+            if not initialize:
+                with profiler.stage('node.load_bind_data'):
+                    loaded = bindData.load(path, key, len(self.jts_pos))
+                    if loaded is not None:
+                        self._core.load_bind_data(*loaded)
+                if loaded is None:
+                    # warn once, bind() isn't called again for the same attributes
+                    self._bind_miss = (bind_cache_dir, rotation_blend, max_influences)
+                    om.MGlobal.displayWarning('%s : no bind data in %s for the current inputs, turn initialize on to bind'
+                                              % (om.MFnDependencyNode(self.thisMObject()).name(), bind_cache_dir))
+                return
+
+        self._bind_miss = None
+
+        # 3 - bind
+        with profiler.stage('node.read_joints'):
+            jts_mats = self.get_joints_state(self._dpJoints, skin_weights.influences)
+        self._core.initialize(positions, base_cvs, base_knots, base_degree, 
+                              jts_mats, skin_weights, self.jts_pos, 
+                              rotation_blend=rotation_blend)
+        if path is not None:
+            with profiler.stage('node.save_bind_data'):
+                bindData.save(self._core.bind_data, path, key, base_knots, base_degree, self.jts_pos)
+
+    def get_bind_pose(self, fnSc, dpJoints):
+        '''
+        Returns the bind matrix of each joint, the inverse of its
+        bindPreMatrix on the skinCluster. Unlike the joint matrices, it
+        doesn't change with the animation
+        :return type: np.array of shape (J, 4, 4)
+        '''
+        pBindPreMatrix = fnSc.findPlug('bindPreMatrix')
+        bind_pose = np.zeros([dpJoints.length(), 4, 4])
+        for i in xrange(dpJoints.length()):
+            index = fnSc.indexForInfluenceObject(dpJoints[i])
+            oMatrix = pBindPreMatrix.elementByLogicalIndex(index).asMObject()
+            bind_pose[i] = self.MMatrix_to_np_mat(om.MFnMatrixData(oMatrix).matrix().inverse())
+        return bind_pose
+
     def get_skin_cluster(self):
         '''
         Also returns the dag path to the inCurve, that is needed for 
@@ -290,350 +426,92 @@ class curveDeformer(omMpx.MPxDeformerNode):
 
         return fnSc, dpInCrv
 
-    def get_skin_weights(self, fnSc, dpInCrv):
+    def get_skin_weights(self, fnSc, dpInCrv, max_influences=None):
         ''' 
-        Returns an array of weights for each CV
-        :param fnSc: function set of the skinCluster
-        :type  fnSc: MFnSkinCluster
-        :param dpInCrv: dag path to the curve attached to the skinCluster
-        :return : list of MDoubleArray
+        Returns the weights of each CV, fetched in a single getWeights call
+        on a component holding all the CVs, and stored as a sparse matrix
+        :param           fnSc: function set of the skinCluster
+        :type            fnSc: MFnSkinCluster
+        :param        dpInCrv: dag path to the curve attached to the skinCluster
+        :param max_influences: if given, only the max_influences largest 
+                               weights of each CV are kept
+        :type  max_influences: int
+        :return type: bindData.SkinWeights
         '''
-        weights = []
-        itCv = om.MItCurveCV(dpInCrv)
+        num_cvs = om.MFnNurbsCurve(dpInCrv).numCVs()
+        fnComp = om.MFnSingleIndexedComponent()
+        oCvs = fnComp.create(om.MFn.kCurveCVComponent)
+        fnComp.setCompleteData(num_cvs)
+
         outArray = om.MDoubleArray()
         nbInflUtil = om.MScriptUtil()
         nbInflUtil.createFromInt(0)
-        while not itCv.isDone():
-            outArray.clear()
-            fnSc.getWeights(dpInCrv, itCv.currentItem(), outArray, nbInflUtil.asUintPtr())
-            weights.append(list(outArray))
-            itCv.next()
-        return weights
-
-    def inverse_distance_weighting(self, pt, poses, p=2):
-        '''
-        Returns a vector of normalized weights, based on the 
-        inverse distance to the reference point. If one of the 
-        poses is on the reference point (i.e. distance=0), 
-        we can't do the invert 1/0, so we edit manually the 
-        vector to have something like [0,...,0,1,0,...]
-        Ex : pt = np.zeros([3])
-             poses = np.array([[-2,0,0],
-                               [-1,0,0],
-                               [0,0,0],
-                               [2,0,0]])
-        wts = inverse_distance_weighting(o, poses)
-
-        :param    pt: reference point, that is responsible for the weighing
-        :type     pt: np.array of n elements
-        :param poses: matrix of shape MxN of each pose we want to assign a weight to
-        :type  poses: np.array of MxN elements
-        :return: np.array of n elements, representing the weights
-        '''
-        num_poses = poses.length()
-        weights_vec = np.zeros([num_poses])
-        for i in xrange(num_poses):
-            cv = np.array([poses[i].x, poses[i].y, poses[i].z])
-            dist = np.linalg.norm(pt - cv)
-            inv_dist = 1./ np.power(dist, p) if dist != 0 else -1
-            weights_vec[i] = inv_dist
-        if -1 in weights_vec:
-            for i in xrange(len(weights_vec)):
-                if weights_vec[i] == -1:
-                    weights_vec[i] = 1 
-                else:
-                    weights_vec[i] = 0
-        weights_vec = weights_vec / np.sum(weights_vec)
-        return weights_vec
-
-    def get_mat_per_cv(self, dpJoints, cvs_array):
-        ''' Computes an average of the weight for each CV, to build 
-        a single matrix that is the orientation of the current CV.
-        This matrix is the weighted sum of all the joints that influence
-        this CV. Right now, it is using euler.
-        TODO - use quaternions to blend the different matrices
-               weighted quats implementation : 
-               https://stackoverflow.com/questions/12374087/average-of-multiple-quaternions
-        :param dpJoints: dag path array for all the joints influencing the curve
-        :type  dpJoints: MDagPathArray
-        '''
-        euler_per_joint = []
-        for j in xrange(dpJoints.length()):
-            inclusive_mat = dpJoints[j].inclusiveMatrix()
-            euler_per_joint.append(om.MTransformationMatrix(inclusive_mat).rotation().asEulerRotation())
-        
-        base_mats_per_cv = om.MMatrixArray()
-        for i in xrange(cvs_array.length()):
-            # get the weighted matrix, using euler
-            transf_mat = self.get_weighted_matrix(euler_per_joint, self._weights[i])#, cvs_array[i])
-            base_mats_per_cv.append(transf_mat)
-        return base_mats_per_cv
-
-    def get_offsets_and_params(self, itGeo, fnBaseCrv):
-        ''' 
-        Computes the offset between each vertex and the closest point on 
-        the curve. And since it's the same command, compute the param of 
-        the closest point on curve at the same time, to feed the nurbsCurve 
-        algorithm with it
-        '''
-        util = om.MScriptUtil()
-        util.createFromDouble(0.)
-        uPtr = util.asDoublePtr()
-        offsets = om.MPointArray()
-        params  = []
-        all_base_mats = []
-        while not itGeo.isDone():
-            # - offset & parameter
-            pos = itGeo.position()
-            pt_on_base_crv = fnBaseCrv.closestPoint(pos, uPtr)
-            param = om.MScriptUtil.getDouble(uPtr)
-            vOffset = pos - pt_on_base_crv
-            offsets.append(om.MPoint(vOffset))
-            params.append(param)
-
-            # all_base_mats.append(self._base_mats_per_cv)
-            itGeo.next()
-        itGeo.reset()
-
-        return offsets, params
+        nbInflPtr = nbInflUtil.asUintPtr()
+        fnSc.getWeights(dpInCrv, oCvs, outArray, nbInflPtr)
+        num_influences = om.MScriptUtil.getUint(nbInflPtr)
+        weights = np.array(outArray, dtype=float).reshape(num_cvs, num_influences)
+        return bindData.SkinWeights.from_dense(weights, max_influences)
 
-    def get_weighted_matrix(self, eulers, weights, pos=None):
-        ''' 
-        Takes an array of eulers, an array of weights of the same size,
-        and outputs one matrix based on the input weights (and the pos)
-        The rotation is done by interpolating each joint, but the translate is 
-        given (usually the position of the CP)
-        '''
-        outX, outY, outZ = 0., 0., 0.
-        for i in xrange(len(weights)):
-            curr_euler  = eulers[i]
-            curr_weight = weights[i]
-            outX += curr_euler.x * curr_weight
-            outY += curr_euler.y * curr_weight
-            outZ += curr_euler.z * curr_weight
-        outEuler = om.MEulerRotation(outX, outY, outZ)
-        outMatrix = outEuler.asMatrix()
-        # add the translates if they are provided
-        if pos:
-            transf_mat = om.MTransformationMatrix(outMatrix)
-            transf_mat.setTranslation(om.MVector(pos), om.MSpace.kWorld)
-            return transf_mat.asMatrix()
-        else:
-            return outMatrix
-
-    def get_3_closest_jts_per_vertex(self, itGeo, joints_pos):
-        ''' In order to compute Tau, we need to compute the angle 
-        at the elbow, between shoulder and wrist. This is in an ideal setup
-        with only 3 bones. But if we have more than 3 bones, to do the same 
-        computation, we need to make sure we work on the correct set of 3 bones.
-        Therefore, we need to check the 3 bones we'll used, regarding the 
-        hierarchy : 
-        Situation 1 - get the closest bone
-                      get its child 
-                      get its parent
-        Situation 2 - get the closest bone
-                      get its child -> NO CHILD
-                      get its parent
-                      get the parent's parent.
-        Situation 3 - get the closest bone
-                      get its child
-                      get its parent -> NO PARENT
-                      get the child's child.
-
-        :param      itGeo: iterator for the geometry
-        :type       itGeo: MItGeometry
-        :param joints_pos: XYZ coordinates for each joint
-        :type  joints_pos: list of np.array
-        :param joints_hierarchy: list of joints, sorted by parent/child
-        :type  joints_hierarchy: list of np.array  
-        :return          : a nested list containing for each vertex a list of 3 indices
-        :return type     : list
-        '''
-        # iter through each vertex to keep the 3 closest joints
-        all_closest_jts_idx = []
-        while not itGeo.isDone():
-            pos = itGeo.position()
-            pos = np.array([pos.x, pos.y, pos.z])
-            dists = []
-            for i in xrange(len(joints_pos)):
-                dists.append(np.linalg.norm(joints_pos[i] - pos))
-
-            sorted_dists = sorted(dists)
-            closest_jt_idx = dists.index(sorted_dists[0])
-            # - get the child
-            child_jt_idx = closest_jt_idx+1
-            # - get the parent
-            parent_jt_idx = closest_jt_idx-1
-            
-            # Situation 1
-            closest_3_jts_idx = [parent_jt_idx, closest_jt_idx, child_jt_idx]
-            # Situation 2 - no child available
-            if closest_jt_idx >= len(joints_pos)-1:
-                closest_3_jts_idx = [parent_jt_idx-1, parent_jt_idx, closest_jt_idx]
-            # Situation 3 - no parent available
-            if closest_jt_idx == 0:
-                closest_3_jts_idx = [closest_jt_idx, child_jt_idx, child_jt_idx+1]
-
-            # sorted_dists = sorted_dists[:3]
-            # closest_3_jts_idx =  [dists.index(sorted_dists[0]),
-            #                       dists.index(sorted_dists[1]),
-            #                       dists.index(sorted_dists[2])]
-            all_closest_jts_idx.append(closest_3_jts_idx)
-            itGeo.next()
-
-        itGeo.reset()
-
-        return all_closest_jts_idx
-
-    def get_default_taus(self, itGeo, P, O, Q):
+    def get_joints_state(self, dpJoints, influences=None):
         '''
-        compute the default Tau value for each vertex, in order to know how to 
-        remap it later, in the deform (if we're in the middle of the elbow, 
-        tau may be .5, but on the sides, it may be 1.2. So we need to call a 
-        remap with different values)
+        Reads the inclusive matrix of each joint only once, and returns them
+        as a contiguous array that can be reused for the whole evaluation. 
+        Each DAG read is counted in num_dag_matrix_reads
+        :param   dpJoints: dag path array for all the joints influencing the curve
+        :type    dpJoints: MDagPathArray
+        :param influences: indices of the joints to read, all of them if not 
+                           given. The others are left to identity, as they 
+                           have no weight
+        :type  influences: np.array of int
+        :return     : matrices of shape (J, 4, 4)
+        :return type: np.array
         '''
-        out_taus = np.zeros([itGeo.count()])
-        while not itGeo.isDone():
-            out_taus[itGeo.index()] = self.get_tau(P, O, Q, itGeo.position())
-            itGeo.next()
-        itGeo.reset()
-        return out_taus
-
-    def get_tau(self, p_idx, o_idx, q_idx, vR):
-        ''' 
-        To know how much the CVs need to be offset to sharpen / smooth 
-        the curve, we compute a parameter at bind pause (we call it Tau), that 
-        will vary based on the bend angle between each joint. In this setup, 
-        shoulder, elbow and wrist positions are respectively P, O and Q. The 
-        vertex we currently compute is known as R
-        :param p_pos: position of the bone P, usually the shoulder
-        :type  p_pos: np.array
-        :param o_pos: position of the bone P, usually the elbow, which rotates
-        :type  o_pos: np.array
-        :param q_pos: position of the bone P, usually the wrist
-        :type  q_pos: np.array
-        :param r_pos: position of the vertex we use to get tau
-        :type  r_pos: np.array
-        :return     : float
-        '''
-        p_pos = np.array(self.jts_pos[p_idx])
-        o_pos = np.array(self.jts_pos[o_idx])
-        q_pos = np.array(self.jts_pos[q_idx])
-        r_pos = np.array([vR.x, vR.y, vR.z])
-
-        # Eq. 1-3
-        p = p_pos - o_pos
-        p_norm = p / np.linalg.norm(p)
-        q = q_pos - o_pos
-        q_norm = q / np.linalg.norm(q)
-        r = r_pos - o_pos
-        r_norm = r / np.linalg.norm(r)
-
-        # Eq. 4-5
-        theta = np.arccos(r_norm.dot(q_norm))  # angle ROQ en radians
-        alpha_min = np.arccos(p_norm.dot(q_norm)) # angle POQ en radians
-
-        # Eq. 6 - make sure we always have the smaller angle
-        cross_pq = np.cross(p_norm, q_norm)
-        cross_rq = np.cross(r_norm, q_norm)
-        
-        # cross_pq_norm = cross_pq / np.linalg.norm(cross_pq) # pas besoin de normaliser je crois
-        # cross_rq_norm = cross_rq / np.linalg.norm(cross_rq)
-        # if cross_pq_norm.dot(cross_rq_norm) >= 0:
-        if cross_pq.dot(cross_rq) >= 0:
-            alpha = alpha_min
-        else:
-            alpha = 2*np.pi - alpha_min
-
-        # alpha est flat quand alpha * (np.pi/alpha) == np.pi
-        theta_flat = theta * (np.pi/alpha)
-        # Eq. 9
-        epsilon = np.linalg.norm(r) * np.cos(theta_flat)  # epsilon = distance depuis O jusqu'a la perpidenculaire a OQ en R
-
-        # Eq. 10
-        a = np.linalg.norm(p)
-        b = np.linalg.norm(q)
-        numerator = a + a*min(0, epsilon) + b*max(0, epsilon)
-        # numerator = a + np.linalg.norm(p*min(0, epsilon)) + np.linalg.norm(q*max(0, epsilon))
-        denominator = a + b
-        tau = numerator / denominator
-        
-        return tau
-
-    def set_offset_direction(self, itGeo, offsets, base_cvs, base_mat_bones):
+        num_jts = dpJoints.length()
+        jts_mats = np.tile(np.eye(4), (num_jts, 1, 1))
+        if influences is None:
+            influences = xrange(num_jts)
+        for j in influences:
+            jts_mats[j] = self.MMatrix_to_np_mat(dpJoints[int(j)].inclusiveMatrix())
+            self.num_dag_matrix_reads += 1
+        return jts_mats
+
+    def get_paint_weights(self, data, geomIndex, num_vertices):
         '''
-        In order to know in which direction we'll push the CVs (using Tau) in 
-        the deform, we set a matrix of values (+1 or -1) that we'll 
-        use in offset_CVs_by_tau() later. In a nutshell, we get the vector 
-        offset_CV->vertex, and we compare it against the main orient axis of the
-        bone (usually -and hardcoded here- +X), and the neg main orient axis 
-        (-X). Then, with cosine similarity, we define if offset_CV-> vertex is 
-        closer from +X or -X.
-        Returns a m x n matrix with m = number of vertices and n = number of CVs
-        each value is either 1 or -1, depending if we wanna push or pull the CV
+        Returns the painted weight of each vertex. The weights are read 
+        directly from the sparse weightList array : only the painted 
+        elements are visited, the others have the default weight of 1
+        :param   geomIndex: index of the deformed geometry
+        :type    geomIndex: int
+        :param num_vertices: number of vertices of the geometry
+        :type  num_vertices: int
+        :return type: np.array of shape (V,)
         '''
-        num_cvs = base_cvs.length() # MPointArray()
-        out_mat = np.ones([itGeo.count(), num_cvs])
-
-        bone_aim_axis = np.array([1,0,0,0])  # hardcoded for now : bones are oriented in +X
-        while not itGeo.isDone():
-            i = itGeo.index()
-            vtx_pos = itGeo.position()
-            for j in xrange(num_cvs):
-                base_cv  = base_cvs[j]
-                offset_cv= base_cv + om.MVector(offsets[i])
-                base_mat = self.MMatrix_to_np_mat(base_mat_bones[j])
-
-                # get the normalized base vector cv->vertex
-                cv_to_pos = vtx_pos - offset_cv
-                np_cv_to_pos = np.array([cv_to_pos.x, cv_to_pos.y, cv_to_pos.z])
-                if np.linalg.norm(np_cv_to_pos) != 0:
-                    np_cv_to_pos = np_cv_to_pos / np.linalg.norm(np_cv_to_pos)
-                    
-                    # get the orientation (i.e. should we push the CV in x or pull it?)
-                    base_bone_orient_pos = self.filter_matrix_axis(base_mat, bone_aim_axis)
-                    base_bone_orient_pos = base_bone_orient_pos / np.linalg.norm(base_bone_orient_pos)
-                    base_bone_orient_neg = -base_bone_orient_pos
-                    pos_x = np_cv_to_pos.dot(base_bone_orient_pos)
-                    neg_x = np_cv_to_pos.dot(base_bone_orient_neg)
-                    if pos_x > neg_x:
-                        out_mat[i, j] = +1
-                    else:
-                        out_mat[i, j] = -1
-                else:
-                    out_mat[i, j] = 0
-
-            itGeo.next()
-
-        itGeo.reset()
-        return out_mat
-
-    def offset_CVs_by_tau(self, pos, offset_cvs, mat_bones, tau, cv_weights, cv_direction):
+        paint_weights = np.ones(num_vertices)
+        hWeightList = data.inputArrayValue(curveDeformer.weightList)
+        try:
+            hWeightList.jumpToElement(geomIndex)
+        except RuntimeError:
+            return paint_weights  # nothing painted yet
+        hWeights = om.MArrayDataHandle(hWeightList.inputValue().child(curveDeformer.weights))
+        for i in xrange(hWeights.elementCount()):
+            hWeights.jumpToArrayElement(i)
+            vtx_index = hWeights.elementIndex()
+            if vtx_index < num_vertices:
+                paint_weights[vtx_index] = hWeights.inputValue().asFloat()
+        return paint_weights
+
+    def get_degree_and_knots(self, fnCrv):
         '''
-        We computed, in the init, whether we should pull or push the CV.
-        To know of how much we move the CV, we multiply the current bone aim 
-        vector by the pre-computed direction (i.e. +1 or -1) by a remapped value of 'tau'
-        :param offset_cvs: offset cvs, after we applied the delta vector to them
+        Returns the degree and the full knot vector (of length number of 
+        CVs + degree + 1) of the curve. Maya doesn't store the first and 
+        last knots, so we duplicate them
         '''
-        vtx_pos = np.array([pos.x, pos.y, pos.z])
-        bone_aim_axis = np.array([1,0,0,0])  # hardcoded for now : bones are oriented in +X
-
-        num_cvs = len(offset_cvs)
-        out_cvs = np.zeros([num_cvs, 3])
-
-        for i in xrange(num_cvs):
-            offset_cv       = offset_cvs[i]
-            mat_bone        = self.MMatrix_to_np_mat(mat_bones[i])
-            bone_aim_vector = self.filter_matrix_axis(mat_bone, bone_aim_axis)
-            bone_aim_vector = bone_aim_vector / np.linalg.norm(bone_aim_vector)
-
-            # offset_vector = om.MPoint(*(bone_aim_vector * cv_weights[i] * cv_direction[i] * tau))
-            offset_vector = om.MPoint(*(bone_aim_vector * cv_weights[i] * tau * -1))
-            new_cv = om.MPoint(*offset_cv) + om.MVector(offset_vector)
-            
-            out_cvs[i] = [new_cv.x, new_cv.y, new_cv.z]
-
-        return out_cvs
+        degree = fnCrv.degree()
+        dummy = om.MDoubleArray()
+        fnCrv.getKnots(dummy)
+        knots = [dummy[i] for i in xrange(dummy.length())]
+        knots = [knots[0]] + knots + [knots[-1]]
+        return degree, knots
 
     # ---------------------- No longer used ------------------------
     def weight_with_rbf(self, n, point, sigma=1):
@@ -734,6 +612,15 @@ class curveDeformer(omMpx.MPxDeformerNode):
     def MMatrix_to_np_mat(self, matrix):
         return np.array([[matrix(j, i) for i in xrange(4)] for j in xrange(4)])
 
+    def MPointArray_to_np(self, points):
+        return np.array([[points[i].x, points[i].y, points[i].z] for i in xrange(points.length())])
+
+    def get_np_positions(self, itGeo):
+        ''' Returns the position of each vertex of the iterator as a (V, 3) array '''
+        points = om.MPointArray()
+        itGeo.allPositions(points)
+        return self.MPointArray_to_np(points)
+
     def _remap(self, value, oldMin, oldMax, newMin, newMax):
         return (((value - oldMin) * (newMax - newMin)) / (oldMax - oldMin)) + newMin
 
@@ -836,6 +723,7 @@ def nodeInitializer():
     nAttr = om.MFnNumericAttribute()
     mAttr = om.MFnMatrixAttribute()
     cAttr = om.MFnCompoundAttribute()
+    eAttr = om.MFnEnumAttribute()
 
     # init
     curveDeformer.aInit = nAttr.create('initialize', 'init', om.MFnNumericData.kBoolean, True)
@@ -866,12 +754,48 @@ def nodeInitializer():
     cAttr.setArray(True)
     curveDeformer.addAttribute(curveDeformer.aMatrixJoints)
 
+    # directory of the bind data files, to reopen a scene without initializing
+    curveDeformer.aBindCacheDir = tAttr.create('bindCacheDirectory', 'bcDir', om.MFnData.kString)
+    curveDeformer.addAttribute(curveDeformer.aBindCacheDir)
+
+    # parallel evaluation : number of threads (0 for one per core), and
+    # number of vertices deformed at once by a thread
+    curveDeformer.aNumThreads = nAttr.create('numThreads', 'nth', om.MFnNumericData.kInt, 1)
+    nAttr.setMin(0)
+    curveDeformer.addAttribute(curveDeformer.aNumThreads)
+    curveDeformer.aChunkSize = nAttr.create('chunkSize', 'chs', om.MFnNumericData.kInt, 4096)
+    nAttr.setMin(1)
+    curveDeformer.addAttribute(curveDeformer.aChunkSize)
+
+    # blend of the joint rotations for each CV, used from the next initialize
+    curveDeformer.aRotationBlend = eAttr.create('rotationBlend', 'rb', curveDeformerCore.ROTATION_BLEND_EULER)
+    eAttr.addField('euler', curveDeformerCore.ROTATION_BLEND_EULER)
+    eAttr.addField('quaternion', curveDeformerCore.ROTATION_BLEND_QUATERNION)
+    curveDeformer.addAttribute(curveDeformer.aRotationBlend)
+
+    # max number of joints per CV, 0 for all of them. Used from the next initialize
+    curveDeformer.aMaxInfluences = nAttr.create('maxInfluences', 'mi', om.MFnNumericData.kInt, 0)
+    nAttr.setMin(0)
+    curveDeformer.addAttribute(curveDeformer.aMaxInfluences)
+
+    # instrumentation : records the time of each stage (see get_stats), and
+    # optionally logs them after each evaluation
+    curveDeformer.aProfile = nAttr.create('profile', 'prf', om.MFnNumericData.kBoolean, False)
+    curveDeformer.addAttribute(curveDeformer.aProfile)
+    curveDeformer.aLogProfile = nAttr.create('logProfile', 'lprf', om.MFnNumericData.kBoolean, False)
+    curveDeformer.addAttribute(curveDeformer.aLogProfile)
+
     # attribute effects
     curveDeformer.attributeAffects(curveDeformer.aInit, curveDeformer.outputGeom)
     curveDeformer.attributeAffects(curveDeformer.aInCrv, curveDeformer.outputGeom)
     curveDeformer.attributeAffects(curveDeformer.aBaseCrv, curveDeformer.outputGeom)
     curveDeformer.attributeAffects(curveDeformer.aCps, curveDeformer.outputGeom)
     curveDeformer.attributeAffects(curveDeformer.aMatrixJoints, curveDeformer.outputGeom)
+    curveDeformer.attributeAffects(curveDeformer.aBindCacheDir, curveDeformer.outputGeom)
+    curveDeformer.attributeAffects(curveDeformer.aNumThreads, curveDeformer.outputGeom)
+    curveDeformer.attributeAffects(curveDeformer.aChunkSize, curveDeformer.outputGeom)
+    curveDeformer.attributeAffects(curveDeformer.aRotationBlend, curveDeformer.outputGeom)
+    curveDeformer.attributeAffects(curveDeformer.aMaxInfluences, curveDeformer.outputGeom)
 
     # make deformer paintable
     om.MGlobal.executeCommand("makePaintable -attrType multiFloat -sm deformer curveDeformer ws;")